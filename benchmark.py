@@ -0,0 +1,247 @@
+# Benchmark of the smart charging pipeline on synthetic fleets
+# Journeys, site meter data and half-hourly tariffs are generated from a
+# seed, so runs can be compared on any machine without the private inputs.
+# Usage: python benchmark.py --vehicles 5 20 --days 3 --reps 3 --out b.json
+
+import argparse
+import datetime as dt
+import itertools
+import json
+import platform
+import numpy as np
+import pandas as pd
+import global_variables as gv
+import lin_prog_functions as lpf
+import output_functions as of
+import testdata_proc as pf
+import timings as tm
+
+VEHICLE = 'Arrival133'
+START = dt.datetime(2021, 3, 1)
+
+
+def set_time_int(minutes):
+    """Sets the length of time periods in global_variables
+
+    Args:
+        minutes (int): length of a time period
+
+    Returns:
+        int: previous length in minutes
+    """
+    previous = int(gv.TIME_INT / dt.timedelta(minutes=1))
+    gv.TIME_INT = dt.timedelta(minutes=minutes)
+    gv.TIME_FRACT = gv.TIME_INT / dt.timedelta(hours=1)
+    gv.DAY_INTERVALS = int(dt.timedelta(days=1) / gv.TIME_INT)
+    return previous
+
+
+def synthetic_inputs(vehicles, days, shifts, seed=0):
+    """Journeys, tariff and site capacity of a synthetic fleet
+
+    Each vehicle leaves between 9:00 and 11:00 every day and does
+    shifts routes with a 1-2.5h turnaround, using 25-70% of its battery
+    over the day. Prices are a day/night tariff with noise, site
+    capacity is a daily building load under a fixed connection.
+    Time periods are gv.TIME_INT long.
+
+    Args:
+        vehicles (int): number of vehicles
+        days (int): number of days
+        shifts (int): routes per vehicle per day
+        seed (int): random seed
+
+    Returns:
+        DataFrame: journeys, as from testdata_proc.prep_data_mixed
+        DataFrame: price table
+        DataFrame: site capacity per time period
+        dict: Vehicle_ID: Vehicle Model
+    """
+    rng = np.random.default_rng(seed)
+    battery = gv.VSPEC[VEHICLE]['C']
+    rows = []
+    for d in range(days):
+        day = START + dt.timedelta(days=d)
+        for v in range(1, vehicles + 1):
+            t = day + dt.timedelta(minutes=int(rng.integers(540, 660)))
+            energy = rng.uniform(0.25, 0.7, shifts) * battery / shifts
+            for s in range(shifts):
+                duration = dt.timedelta(minutes=int(rng.integers(90, 240)))
+                rows.append({
+                    'date': pd.Timestamp(day),
+                    'Route_ID': len(rows),
+                    'Vehicle_ID': v,
+                    'Start_Time_of_Route': t,
+                    'End_Time_of_Route': t + duration,
+                    'Energy_Required': energy[s],
+                    'Van': VEHICLE,
+                })
+                t += duration + dt.timedelta(
+                    minutes=int(rng.integers(60, 150)))
+    journeys = pd.DataFrame(rows).set_index(['date', 'Route_ID'])
+
+    # One day either side for the last charging session and next_req
+    frm = pd.date_range(START, START + dt.timedelta(days=days + 2),
+                        freq=gv.TIME_INT, inclusive='left')
+    hours = frm.hour + frm.minute / 60
+    price = pd.DataFrame({
+        'from': frm,
+        'Electricity_Price': np.where((hours >= 7) & (hours < 20),
+                                      15.0, 5.0)
+        + rng.uniform(0, 1, len(frm)),
+        'Time_Price': np.arange(len(frm)) / 1000,
+    })
+    connection = 30 + 8 * vehicles
+    load = 0.4 * connection * (1 + np.sin((hours - 9) / 24 * 2 * np.pi)) / 2
+    capacity = pd.DataFrame({
+        'Available_kW': connection - load
+        - rng.uniform(0, 0.1, len(frm)) * connection,
+        'Available_nolim': 20000,
+    }, index=pd.Index(frm, name='DateTime'))
+    dictV = {v: VEHICLE for v in range(1, vehicles + 1)}
+    return journeys, price, capacity, dictV
+
+
+def time_scenario(vehicles, days, shifts, time_int, optimiser=None, seed=0):
+    """Times one run of the pipeline on a synthetic fleet
+
+    Stages are create_empty_schedule, optimise_range3 and
+    summary_outputs, plus the stages timed inside them (build, solve,
+    fallback levels, see timings.py).
+
+    Args:
+        vehicles (int): number of vehicles
+        days (int): number of days
+        shifts (int): routes per vehicle per day
+        time_int (int): length of time periods in minutes
+        optimiser (function): daily optimiser for optimise_range3
+        seed (int): random seed
+
+    Returns:
+        dict: stages (calls, wall and cpu per stage), objective (energy
+            cost of the range), levels (number of days per level) and
+            solve_paths (solve and overhead times per path, see
+            lin_prog_functions.solve_overhead)
+    """
+    previous = set_time_int(time_int)
+    try:
+        journeys, price, capacity, dictV = synthetic_inputs(
+            vehicles, days, shifts, seed)
+        site_capacity = {
+            'opt': capacity['Available_kW'],
+            'BAU': capacity['Available_nolim']
+        }
+        tm.reset()
+        empty_profs = pf.create_empty_schedule(journeys, price)
+        with tm.stage('optimise_range3'):
+            (profile_out, dates, bad_days, lpprob, status, bats,
+             telemetry) = lpf.optimise_range3(
+                empty_profs, [11, 22], site_capacity, dictV, [[1]],
+                optimiser=optimiser)
+        range_profile, site_profile, days_summary, global_summary = (
+            of.summary_outputs(profile_out, journeys,
+                               capacity['Available_kW'], status, dictV,
+                               bats))
+    finally:
+        set_time_int(previous)
+    ca = gv.CATS[0]
+    levels = status[gv.CAT_COLS['LEVEL'][ca]].value_counts()
+    return {
+        'stages': tm.snapshot(),
+        'objective': float(global_summary[gv.CAT_COLS['ECOST'][ca]]),
+        'levels': {k: int(n) for k, n in levels.items()},
+        'solve_paths': lpf.solve_overhead(telemetry).dropna(
+            axis=1, how='all').to_dict('index'),
+    }
+
+
+def scenario_name(vehicles, days, shifts, time_int):
+    return 'v{}_d{}_s{}_t{}'.format(vehicles, days, shifts, time_int)
+
+
+def run_benchmark(vehicles, days, shifts, time_ints, reps=3,
+                  optimiser=None, seed=0):
+    """Runs every combination of sizes reps times
+
+    Args:
+        vehicles (list): numbers of vehicles
+        days (list): numbers of days
+        shifts (list): routes per vehicle per day
+        time_ints (list): lengths of time periods in minutes
+        reps (int): repetitions of each scenario
+        optimiser (function): daily optimiser for optimise_range3
+        seed (int): random seed, the same for all repetitions
+
+    Returns:
+        dict: meta (machine and settings) and runs (one per scenario /
+            repetition, see time_scenario)
+    """
+    runs = []
+    for nv, nd, ns, ti in itertools.product(vehicles, days, shifts,
+                                            time_ints):
+        for rep in range(reps):
+            res = time_scenario(nv, nd, ns, ti, optimiser, seed)
+            runs.append(dict(
+                scenario=scenario_name(nv, nd, ns, ti), vehicles=nv,
+                days=nd, shifts=ns, time_int=ti, rep=rep, **res))
+            print(runs[-1]['scenario'], 'rep', rep, '{:.2f}s'.format(
+                res['stages']['optimise_range3']['wall']))
+    meta = {
+        'created': dt.datetime.now().isoformat(timespec='seconds'),
+        'machine': platform.platform(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'optimiser': (optimiser or lpf.linear_optimiser_V6).__name__,
+        'pipeline': gv.PIPELINE,
+        'in_process': gv.SOLVER_IN_PROCESS,
+        'seed': seed,
+        'reps': reps,
+    }
+    return {'meta': meta, 'runs': runs}
+
+
+def results_table(results):
+    """Wall time per scenario and stage, mean over repetitions
+
+    Args:
+        results (dict): output of run_benchmark
+
+    Returns:
+        DataFrame: scenarios as rows, stages as columns
+    """
+    rows = [
+        {'scenario': run['scenario'], 'stage': name, 'wall': rec['wall']}
+        for run in results['runs'] for name, rec in run['stages'].items()]
+    return pd.DataFrame(rows).pivot_table(
+        index='scenario', columns='stage', values='wall', aggfunc='mean')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the pipeline on synthetic fleets')
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[5, 20])
+    parser.add_argument('--days', type=int, nargs='+', default=[3])
+    parser.add_argument('--shifts', type=int, nargs='+', default=[2])
+    parser.add_argument('--time-int', type=int, nargs='+', default=[30],
+                        help='length of time periods in minutes')
+    parser.add_argument('--reps', type=int, default=3)
+    parser.add_argument('--optimiser', default='linear_optimiser_V6',
+                        help='daily optimiser in lin_prog_functions')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--in-process', action='store_true',
+                        help='solve PuLP problems with HiGHS in-process')
+    parser.add_argument('--out', default='benchmark.json')
+    args = parser.parse_args()
+    gv.SOLVER_IN_PROCESS = args.in_process
+    # Sampled CBC solves would add to the stage times being compared
+    gv.CMD_OVERHEAD_SAMPLE = None
+
+    results = run_benchmark(
+        args.vehicles, args.days, args.shifts, args.time_int, args.reps,
+        getattr(lpf, args.optimiser), args.seed)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(results_table(results).round(3).to_string())
+    print('Results saved to', args.out)
@@ -0,0 +1,199 @@
+# Regression gate between two benchmark.py result files
+# Reports the change in time of each scenario / stage with a confidence
+# interval over the repetitions, and checks the answers still match.
+# Exits with 1 if a stage is slower beyond the threshold, a baseline
+# stage is missing from the candidate (unless --allow-missing) or an
+# answer changed, e.g.
+# python benchmark_compare.py base.json new.json --threshold 0.1
+
+import argparse
+import json
+import sys
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+COLUMNS = ['scenario', 'stage', 'base', 'candidate', 'speedup', 'change',
+           'ci_low', 'ci_high', 'verdict']
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def stage_times(results, metric='wall'):
+    """Times of each scenario / stage over the repetitions
+
+    Args:
+        results (dict): benchmark.py results
+        metric (str): 'wall' or 'cpu'
+
+    Returns:
+        dict: (scenario, stage): array of times (s)
+    """
+    times = {}
+    for run in results['runs']:
+        for stage, rec in run['stages'].items():
+            times.setdefault((run['scenario'], stage), []).append(rec[metric])
+    return {k: np.array(v) for k, v in times.items()}
+
+
+def relative_change(base, cand, confidence=0.95):
+    """Change in mean time relative to the baseline, with its CI
+
+    Welch's t interval on the difference of means, divided by the
+    baseline mean. Bounds are NaN with fewer than 2 repetitions.
+
+    Args:
+        base (array): baseline times
+        cand (array): candidate times
+        confidence (float): confidence level of the interval
+
+    Returns:
+        float: relative change (0.1 is 10% slower)
+        float, float: lower and upper bounds of the interval
+    """
+    mb, mc = base.mean(), cand.mean()
+    change = (mc - mb) / mb
+    if len(base) < 2 or len(cand) < 2:
+        return change, np.nan, np.nan
+    vb = base.var(ddof=1) / len(base)
+    vc = cand.var(ddof=1) / len(cand)
+    se = np.sqrt(vb + vc)
+    if se == 0:
+        return change, change, change
+    dof = (vb + vc)**2 / (vb**2 / (len(base) - 1) + vc**2 / (len(cand) - 1))
+    half = stats.t.ppf((1 + confidence) / 2, dof) * se
+    return change, (mc - mb - half) / mb, (mc - mb + half) / mb
+
+
+def compare_times(baseline, candidate, threshold=0.1, confidence=0.95,
+                  min_time=0.05, metric='wall'):
+    """Change in time of every scenario / stage in both files
+
+    A stage regresses when it's slower than threshold with the given
+    confidence (the lower bound of the interval is above threshold, or
+    the change itself with a single repetition). Stages that take less
+    than min_time in the baseline are reported but never regress.
+
+    Args:
+        baseline (dict): benchmark.py results of the baseline
+        candidate (dict): benchmark.py results to check
+        threshold (float): relative slowdown allowed
+        confidence (float): confidence level of the intervals
+        min_time (float): baseline mean time (s) below which timings
+            are too noisy to gate on
+        metric (str): 'wall' or 'cpu'
+
+    Returns:
+        DataFrame: mean times, change and interval per scenario / stage,
+            with a verdict (faster, slower, same, regression, or missing
+            for baseline stages the candidate doesn't have)
+    """
+    base_times = stage_times(baseline, metric)
+    cand_times = stage_times(candidate, metric)
+    rows = []
+    for key in sorted(base_times.keys() - cand_times.keys()):
+        rows.append({'scenario': key[0], 'stage': key[1],
+                     'base': base_times[key].mean(), 'verdict': 'missing'})
+    for key in sorted(base_times.keys() & cand_times.keys()):
+        base, cand = base_times[key], cand_times[key]
+        change, low, high = relative_change(base, cand, confidence)
+        sure_low = change if np.isnan(low) else low
+        sure_high = change if np.isnan(high) else high
+        if sure_low > threshold and base.mean() >= min_time:
+            verdict = 'regression'
+        elif sure_low > 0:
+            verdict = 'slower'
+        elif sure_high < 0:
+            verdict = 'faster'
+        else:
+            verdict = 'same'
+        rows.append({
+            'scenario': key[0], 'stage': key[1],
+            'base': base.mean(), 'candidate': cand.mean(),
+            'speedup': base.mean() / cand.mean() if cand.mean() else np.inf,
+            'change': change, 'ci_low': low, 'ci_high': high,
+            'verdict': verdict,
+        })
+    return pd.DataFrame(rows, columns=COLUMNS).set_index(
+        ['scenario', 'stage'])
+
+
+def compare_answers(baseline, candidate, rtol=1e-6):
+    """Checks objectives and days per level of each scenario match
+
+    Args:
+        baseline (dict): benchmark.py results of the baseline
+        candidate (dict): benchmark.py results to check
+        rtol (float): relative tolerance on the objective
+
+    Returns:
+        list: description of each mismatch, empty if all match
+    """
+    def answers(results):
+        out = {}
+        for run in results['runs']:
+            out.setdefault(run['scenario'], []).append(
+                (run['objective'], run['levels']))
+        return out
+
+    base, cand = answers(baseline), answers(candidate)
+    mismatches = []
+    for scenario in sorted(base.keys() - cand.keys()):
+        mismatches.append('{}: missing from the candidate'.format(scenario))
+    for scenario in sorted(base.keys() & cand.keys()):
+        objective, levels = base[scenario][0]
+        for obj, lev in cand[scenario]:
+            if not np.isclose(obj, objective, rtol=rtol, atol=0):
+                mismatches.append('{}: objective {} != {}'.format(
+                    scenario, obj, objective))
+                break
+            if lev != levels:
+                mismatches.append('{}: levels {} != {}'.format(
+                    scenario, lev, levels))
+                break
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Regression gate between two benchmark.py files')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown allowed per stage')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='baseline time (s) below which stages '
+                        'never regress')
+    parser.add_argument('--metric', choices=['wall', 'cpu'], default='wall')
+    parser.add_argument('--rtol', type=float, default=1e-6,
+                        help='relative tolerance on objective values')
+    parser.add_argument('--allow-missing', action='store_true',
+                        help='pass even if baseline stages are missing '
+                        'from the candidate')
+    args = parser.parse_args()
+
+    baseline = load_results(args.baseline)
+    candidate = load_results(args.candidate)
+    table = compare_times(baseline, candidate, args.threshold,
+                          args.confidence, args.min_time, args.metric)
+    with pd.option_context('display.width', 200,
+                           'display.max_rows', None):
+        print(table.round(4).to_string())
+    regressions = table[table['verdict'] == 'regression']
+    missing = table[table['verdict'] == 'missing']
+    mismatches = compare_answers(baseline, candidate, args.rtol)
+    for key in missing.index:
+        print('MISSING {} {}: not in the candidate'.format(*key))
+    for key, row in regressions.iterrows():
+        print('REGRESSION {} {}: {:+.1%} ({:+.1%} to {:+.1%})'.format(
+            key[0], key[1], row['change'], row['ci_low'], row['ci_high']))
+    for m in mismatches:
+        print('ANSWER CHANGED', m)
+    if len(regressions) or mismatches or (
+            len(missing) and not args.allow_missing):
+        sys.exit(1)
+    print('No regressions')
@@ -0,0 +1,210 @@
+# Dense (day x period x vehicle) profile container
+# Array-backed alternative to the long MultiIndex profile DataFrame
+
+import numpy as np
+import pandas as pd
+import datetime as dt
+import global_variables as gv
+
+PRICE_COLS = ['Electricity_Price', 'Time_Price']
+
+
+class DenseProfile:
+    """Empty profile of a range stored as contiguous arrays
+
+    Vehicle arrays are indexed [day, period, vehicle] and price arrays
+    [day, period]. A day starts at gv.CHAR_ST, like in
+    create_daily_schedule, so selecting a day is a view, not a copy.
+
+    Attributes:
+        start (datetime): first time period of the range
+        vehicles (Index): Vehicle_IDs, in column order
+        available (int8 array): 1 when the vehicle is plugged in
+        battery_use (float32 array): energy used on return (negative)
+        session (int32 array): charging session ID
+        ret (int8 array): 1 on the period a vehicle returns
+        prices (dict): price column: float32 array
+    """
+
+    def __init__(self, start, vehicles, available, battery_use, session,
+                 ret, prices):
+        self.start = pd.Timestamp(start)
+        self.vehicles = pd.Index(vehicles, name='Vehicle_ID')
+        self.available = available
+        self.battery_use = battery_use
+        self.session = session
+        self.ret = ret
+        self.prices = prices
+
+    @classmethod
+    def from_frame(cls, profile):
+        """Creates a dense profile from a create_empty_schedule output
+
+        Args:
+            profile (DataFrame): MultiIndex profile of each vehicle
+                / time period
+
+        Returns:
+            DenseProfile
+        """
+        profile = profile.sort_index()
+        frm = profile.index.get_level_values(0).unique()
+        vehicles = profile.index.get_level_values(1).unique()
+        periods = int(dt.timedelta(days=1) / gv.TIME_INT)
+        expected = pd.date_range(frm[0], periods=len(frm), freq=gv.TIME_INT)
+        if (len(frm) % periods or not frm.equals(expected)
+                or len(profile) != len(frm) * len(vehicles)):
+            raise ValueError(
+                'Profile must cover whole days of every time period '
+                'for every vehicle')
+        if frm[0].time() != gv.CHAR_ST:
+            raise ValueError('Profile must start at CHAR_ST ({})'.format(
+                gv.CHAR_ST))
+        shape = (len(frm) // periods, periods, len(vehicles))
+
+        def dense(col, dtype):
+            return np.ascontiguousarray(
+                profile[col].values.reshape(shape), dtype=dtype)
+
+        prices = {
+            col: np.ascontiguousarray(
+                profile[col].values.reshape(shape)[:, :, 0],
+                dtype=np.float32)
+            for col in PRICE_COLS}
+        return cls(frm[0], vehicles, dense('Available', np.int8),
+                   dense('Battery_Use', np.float32),
+                   dense('Session', np.int32), dense('Return', np.int8),
+                   prices)
+
+    @property
+    def days(self):
+        """Start date of each day"""
+        return pd.date_range(self.start.normalize(),
+                             periods=self.available.shape[0], freq='D')
+
+    def timeline(self):
+        """Time period of each [day, period]"""
+        num_d, num_p, _ = self.available.shape
+        return pd.date_range(self.start, periods=num_d * num_p,
+                             freq=gv.TIME_INT)
+
+    def calendar_dates(self):
+        """Calendar dates of all time periods, like optimise_range3"""
+        return np.unique(self.timeline().date)
+
+    def day(self, date):
+        """Selects the day starting at gv.CHAR_ST of a date
+
+        Args:
+            date (datetime): date of the day
+
+        Returns:
+            DenseDay: view of that day, empty if it's out of range
+        """
+        i = (pd.Timestamp(date).normalize() - self.days[0]).days
+        if not 0 <= i < self.available.shape[0]:
+            return DenseDay(self, None)
+        return DenseDay(self, i)
+
+    def daily_use(self):
+        """Battery use of each vehicle per day
+
+        Returns:
+            DataFrame: Battery_Use, MultiIndex (date, Vehicle_ID)
+        """
+        index = pd.MultiIndex.from_product(
+            [self.days, self.vehicles], names=['date', 'Vehicle_ID'])
+        return pd.DataFrame({
+            'Battery_Use': self.battery_use.astype(float).sum(
+                axis=1).ravel()}, index=index)
+
+    def to_frame(self):
+        """Converts back to the long MultiIndex profile
+
+        Returns:
+            DataFrame: same layout as create_empty_schedule
+        """
+        return _long_frame(
+            self.timeline(), self.vehicles,
+            {col: p.reshape(-1) for col, p in self.prices.items()},
+            self.available.reshape(-1, len(self.vehicles)),
+            self.battery_use.reshape(-1, len(self.vehicles)),
+            self.session.reshape(-1, len(self.vehicles)),
+            self.ret.reshape(-1, len(self.vehicles)))
+
+
+class DenseDay:
+    """View of a single day of a DenseProfile
+
+    Attributes hold [period, vehicle] views of the parent arrays.
+    """
+
+    def __init__(self, parent, i):
+        self.vehicles = parent.vehicles
+        self.i = i
+        if i is None:
+            self.shape = (0, len(parent.vehicles))
+            return
+        num_p = parent.available.shape[1]
+        self.start = parent.start + i * dt.timedelta(days=1)
+        self.available = parent.available[i]
+        self.battery_use = parent.battery_use[i]
+        self.session = parent.session[i]
+        self.ret = parent.ret[i]
+        self.prices = {col: p[i] for col, p in parent.prices.items()}
+        self.shape = (num_p, len(parent.vehicles))
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def timeline(self):
+        return pd.date_range(self.start, periods=self.shape[0],
+                             freq=gv.TIME_INT)
+
+    def arrays(self, price_col, capacity):
+        """Same arrays as sparse_model.day_arrays, without a DataFrame"""
+        frm = self.timeline
+        return {
+            'from': frm,
+            'vehicles': self.vehicles,
+            'available': self.available == 1,
+            'battery_use': self.battery_use.astype(float),
+            'session': self.session.astype(np.int64),
+            'return': self.ret == 1,
+            'price': self.prices[price_col].astype(float),
+            'capacity': capacity.reindex(frm).values.astype(float),
+            'shape': self.shape,
+        }
+
+    def to_frame(self):
+        """Converts to the profile create_daily_schedule would give"""
+        return _long_frame(
+            self.timeline, self.vehicles, self.prices, self.available,
+            self.battery_use, self.session, self.ret)
+
+
+def _long_frame(frm, vehicles, prices, available, battery_use, session,
+                ret):
+    num_v = len(vehicles)
+    profiles = pd.DataFrame({
+        'from': np.repeat(frm, num_v),
+        'Vehicle_ID': np.tile(vehicles, len(frm)),
+    })
+    for col in PRICE_COLS:
+        profiles[col] = np.repeat(prices[col].astype(float), num_v)
+    profiles['date'] = pd.to_datetime(
+        (profiles['from'] - gv.CHAR_ST_DELTA).dt.date)
+    profiles['Available'] = available.astype(int).ravel()
+    profiles['Battery_Use'] = battery_use.astype(float).ravel()
+    profiles['Session'] = session.astype(int).ravel()
+    profiles['Return'] = ret.astype(int).ravel()
+    profiles.set_index(['from', 'Vehicle_ID'], inplace=True)
+    return profiles
+
+
+def as_frame(profile):
+    """Returns a DataFrame profile, converting dense ones"""
+    if isinstance(profile, (DenseProfile, DenseDay)):
+        return profile.to_frame()
+    return profile
@@ -0,0 +1,92 @@
+# Analytic feasibility screen for the daily charging MILP
+# Simple energy bounds that prove a fallback level unfeasible without
+# calling the solver.
+
+import numpy as np
+import global_variables as gv
+
+LEVELS = ['Main', 'Tonext', 'Breach', 'Magic']
+TOL = 1e-6  # kWh, so rounding never rules out a feasible level
+
+
+def screen_day(arrays, charger1, charger2, rel_charge, next_req,
+               battery_cap):
+    """Finds the first fallback level not proven unfeasible
+
+    Checks necessary conditions only: a level that passes may still be
+    unfeasible, but a level that fails can't be solved.
+    - Vehicle: energy required by a vehicle over the day is more than
+      its max charger power over its available periods
+    - Return: a vehicle can't get enough charge before a return to stay
+      above 0% SOC (unfeasible at every level)
+    - Site: energy required by all vehicles is more than the integral of
+      site capacity (limited by chargers and fast chargers) over the day
+      (Breach doubles the site capacity)
+
+    Args:
+        arrays (dict): output of sparse_model.day_arrays
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        rel_charge (array): initial charge relative to full per vehicle
+        next_req (array): battery requirements for next day per vehicle
+        battery_cap (array): battery capacity of each vehicle
+
+    Returns:
+        str: first level that may be feasible (see LEVELS)
+        str: the bounds that failed, empty if Main may be feasible
+    """
+    av = arrays['available']
+    bu = arrays['battery_use']
+    rel = np.asarray(rel_charge, dtype=float)
+    cap_v = np.asarray(battery_cap, dtype=float)
+    req = np.asarray(next_req, dtype=float)
+    vehicles = np.asarray(arrays['vehicles'])
+    fast = charger2 if gv.NUM_FAST_CH > 0 else charger1
+    max_power = max(charger1, fast) * gv.TIME_FRACT
+    # Max energy into the batteries per vehicle until each period
+    max_cumul = av.cumsum(axis=0) * max_power * gv.CHARGER_EFF
+    # Max site output per period: chargers, fast chargers and capacity
+    n_av = av.sum(axis=1)
+    chargers = (charger1 * n_av + (fast - charger1) * np.minimum(
+        n_av, gv.NUM_FAST_CH)) * gv.TIME_FRACT
+    # Clipped at 0: a negative capacity (periods with no vehicle in
+    # have no row in the MILP) must never lower the bound
+    site = np.maximum(np.minimum(
+        chargers, arrays['capacity'] * gv.TIME_FRACT), 0)
+    site_breach = np.maximum(np.minimum(
+        chargers, 2 * arrays['capacity'] * gv.TIME_FRACT), 0)
+
+    failed = []
+    # Returns: cumulative charge at each return must cover the use
+    cumul_need = -(bu.cumsum(axis=0) + rel + cap_v)
+    short = arrays['return'] & (cumul_need > max_cumul + TOL)
+    if short.any():
+        t, v = np.nonzero(short)
+        failed.append('Return: vehicle {} at {}'.format(
+            vehicles[v[0]], arrays['from'][t[0]]))
+        return 'Magic', '; '.join(failed)
+
+    # Energy to deliver at each level
+    need = {
+        'Main': -(bu.sum(axis=0) + rel),
+        'Tonext': np.maximum(-(bu.sum(axis=0) + rel + cap_v + req), 0),
+    }
+    need['Breach'] = need['Tonext']
+    site_max = {
+        'Main': site.sum(),
+        'Tonext': site.sum(),
+        'Breach': site_breach.sum(),
+    }
+    for level in LEVELS[:-1]:
+        over = need[level] > max_cumul[-1] + TOL
+        if over.any():
+            failed.append('{} vehicle: {} needs {:.1f} kWh'.format(
+                level, vehicles[over][0], need[level][over][0]))
+            continue
+        total = need[level].sum() / gv.CHARGER_EFF
+        if total > site_max[level] + TOL:
+            failed.append('{} site: {:.1f} > {:.1f} kWh'.format(
+                level, total, site_max[level]))
+            continue
+        return level, '; '.join(failed)
+    return 'Magic', '; '.join(failed)
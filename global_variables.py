@@ -17,11 +17,30 @@ REF_CONS = 0  # Refrigeration use. Zero if already accounted for.
 TIME_INT = dt.timedelta(minutes=30)
 TIME_FRACT = TIME_INT / dt.timedelta(hours=1)
 DAY_INTERVALS = 48
+SOC_FORM = 'cumulative'  # 'state': one SOC variable per period, O(T) rows
+PIPELINE = False  # Prepare the next day while the current one solves
+HORIZON = 1  # Days optimised together, keeping the first (rolling horizon)
+HEURISTIC_GAP = 0.05  # Max gap to the LP bound, None: no LP check
+SOLVER = None  # 'CBC', 'HiGHS' or 'GLPK', None: default per model type
+SOLVER_TIME_LIMIT = None  # Seconds per solve, None for no limit
+SOLVER_GAP = None  # Relative MIP gap, None for the solver's default
+SOLVER_THREADS = None
+SOLVER_IN_PROCESS = False  # True: PuLP problems on HiGHS in-process
+CMD_OVERHEAD_SAMPLE = 10  # In-process: every Nth PuLP solve also timed on
+                          # CBC's subprocess path, None: never
 
 # Paths
 LOGS = os.path.join('Outputs', 'LogsMixed')  # Where the outputs go
 INPUTS = 'Inputs'  # Site capacity, tariffs
 JOURNEYS = 'Inputs'
+PROFILE_CACHE = os.path.join('Outputs', 'ProfileCache')
+PROFILE_CACHE_MB = 2000  # Least recently used profiles deleted above this
+OUTPUT_FORMAT = 'pickle'  # 'parquet': datasets by branch/date
+STREAM_RANGE = False  # Store outputs day by day (parquet only)
+DEFER_RENDER = True  # Draw figures in their own processes after each run
+RENDER_WORKERS = 2
+FIGURES = None  # Figure types from render.FIGURES, all if None
+HEADLESS = True  # Never open a viewer for figures
 
 IMPORT_COLS = ['Route_ID', 'Branch_ID', 'Start_Time_of_Route',
                'End_Time_of_Route', 'Energy_Required', 'vannumber_ev_']
@@ -0,0 +1,198 @@
+# Greedy charging heuristic for a single day
+# Fills each vehicle's energy need in its cheapest available periods,
+# as a fast alternative to the MILP for sizing studies.
+
+import heapq
+import numpy as np
+import global_variables as gv
+import sparse_model as sm
+
+TOL = 1e-6  # kWh
+MAX_RETRIES = 20  # Refills of the day after a missed deadline
+
+
+def assign_fast_chargers(arrays, need):
+    """Gives fast chargers to the sessions that need them the most
+
+    Sessions are taken from a heap by the average energy their vehicle
+    needs per available period, and get a fast charger if one is free
+    in all their periods.
+
+    Args:
+        arrays (dict): output of sparse_model.day_arrays
+        need (array): energy each vehicle needs over the day
+
+    Returns:
+        array: (period, vehicle) bool, True where on a fast charger
+    """
+    av = arrays['available']
+    session = arrays['session']
+    fast = np.zeros(av.shape, dtype=bool)
+    if gv.NUM_FAST_CH <= 0:
+        return fast
+    rate = need / np.maximum(av.sum(axis=0), 1)
+    heap = []
+    for s in np.unique(session[av]):
+        cells = av & (session == s)
+        v = np.flatnonzero(cells.any(axis=0))[0]
+        heapq.heappush(heap, (-rate[v], int(s)))
+    in_use = np.zeros(av.shape[0], dtype=int)
+    while heap:
+        _, s = heapq.heappop(heap)
+        cells = av & (session == s)
+        periods = cells.any(axis=1)
+        if (in_use[periods] < gv.NUM_FAST_CH).all():
+            fast |= cells
+            in_use[periods] += 1
+    return fast
+
+
+def greedy_schedule(arrays, charger1, charger2, rel_charge, battery_cap):
+    """Schedules outputs of a day to get every vehicle back to 100%
+
+    Energy needs are split into deadlines: enough charge to stay above
+    0% at each return and back to 100% at the end of the day. Deadlines
+    are filled earliest first (the vehicles with the least site capacity
+    in their periods first), each from a heap of the vehicle's
+    available periods before it, cheapest first, within charger power,
+    remaining site capacity and the room left below 100% SOC. If a
+    deadline can't be met, it's moved to the front and the day is filled
+    again, up to MAX_RETRIES times.
+
+    Args:
+        arrays (dict): output of sparse_model.day_arrays
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        rel_charge (array): initial charge relative to full per vehicle
+        battery_cap (array): battery capacity of each vehicle
+
+    Returns:
+        array: (period, vehicle) outputs, None if a need can't be met
+        array: (period, vehicle) bool, True where on a fast charger
+    """
+    av = arrays['available']
+    rel = np.asarray(rel_charge, dtype=float)
+    cap_v = np.asarray(battery_cap, dtype=float)
+    T, V = arrays['shape']
+    cumul_use = arrays['battery_use'].cumsum(axis=0)
+    need = -(cumul_use[-1] + rel)
+    if (need < -TOL).any():
+        return None, None
+    fast = assign_fast_chargers(arrays, np.maximum(need, 0))
+    power = np.where(fast, charger2, charger1) * gv.TIME_FRACT * av
+
+    # (deadline, tightness, vehicle, charge needed by then), vehicles
+    # with the least site capacity in their periods per kWh go first
+    window = np.cumsum(arrays['capacity'][:, None] * av, axis=0)
+    deadlines = [(T - 1, -need[v] / max(window[-1, v], TOL), v, need[v])
+                 for v in range(V)]
+    for t, v in zip(*np.nonzero(arrays['return'])):
+        target = -(cumul_use[t, v] + rel[v] + cap_v[v])
+        deadlines.append((t, -target / max(window[t, v], TOL), v, target))
+    order = [(end, v, target) for end, _, v, target in sorted(deadlines)]
+    for _ in range(MAX_RETRIES + 1):
+        outputs, failed = _fill_deadlines(order, arrays, power, rel,
+                                          cumul_use)
+        if failed is None:
+            return outputs, fast
+        order.insert(0, order.pop(failed))
+    return None, fast
+
+
+def _fill_deadlines(order, arrays, power, rel, cumul_use):
+    """Fills deadlines in order, returns the index of the first missed"""
+    av = arrays['available']
+    price = arrays['price']
+    eff = gv.CHARGER_EFF
+    site_left = arrays['capacity'] * gv.TIME_FRACT
+    outputs = np.zeros(arrays['shape'])
+
+    def room(v, t, stop=None):
+        # Output that fits below 100% SOC from period t until stop
+        soc = rel[v] + cumul_use[:, v] + eff * outputs[:, v].cumsum()
+        return (0.00001 - soc[t:stop][av[t:stop, v]]).min() / eff
+
+    for i, (end, v, target) in enumerate(order):
+        short = target - eff * outputs[:end + 1, v].sum()
+        if short <= TOL:
+            continue
+        periods = np.flatnonzero(av[:end + 1, v])
+        heap = [(price[t], t) for t in periods]
+        heapq.heapify(heap)
+        while short > TOL and heap:
+            _, t = heapq.heappop(heap)
+            x = min(power[t, v] - outputs[t, v], site_left[t],
+                    short / eff, room(v, t))
+            if x > 0:
+                outputs[t, v] += x
+                site_left[t] -= x
+                short -= x * eff
+        # Site is full: move other vehicles within their sessions
+        for t in periods[np.argsort(price[periods], kind='stable')]:
+            if short <= TOL:
+                break
+            x = min(power[t, v] - outputs[t, v], short / eff, room(v, t))
+            if x <= TOL:
+                continue
+            site_left[t] += _move_out(t, x - site_left[t], v, arrays,
+                                      outputs, site_left, power, room)
+            x = min(x, site_left[t])
+            outputs[t, v] += x
+            site_left[t] -= x
+            short -= x * eff
+        if short > TOL:
+            return outputs, i
+    return outputs, None
+
+
+def _move_out(t, amount, skip, arrays, outputs, site_left, power, room):
+    """Moves other vehicles' outputs out of period t, cheapest first
+
+    Outputs only move within the same charging session, so no return
+    is crossed. Moving earlier needs room below 100% SOC in between.
+
+    Returns:
+        float: output freed in period t
+    """
+    av = arrays['available']
+    session = arrays['session']
+    price = arrays['price']
+    freed = 0
+    for u in np.flatnonzero(outputs[t] > TOL):
+        if u == skip:
+            continue
+        others = np.flatnonzero(av[:, u] & (session[:, u] == session[t, u]))
+        for t2 in others[np.argsort(price[others], kind='stable')]:
+            if freed >= amount - TOL:
+                return freed
+            if t2 == t:
+                continue
+            x = min(outputs[t, u], amount - freed, site_left[t2],
+                    power[t2, u] - outputs[t2, u])
+            if t2 < t and x > TOL:
+                # Charged earlier: SOC goes up from t2 until t
+                x = min(x, room(u, t2, t))
+            if x > TOL:
+                outputs[t, u] -= x
+                outputs[t2, u] += x
+                site_left[t2] -= x
+                freed += x
+    return freed
+
+
+def lp_bound(model):
+    """Cost of the LP relaxation, a lower bound of the MILP's cost
+
+    Args:
+        model (SparseModel): model with its initial SOC set
+
+    Returns:
+        float: lower bound, None if the relaxation is unfeasible
+    """
+    integrality = model.integrality
+    model.integrality = np.zeros_like(integrality)
+    try:
+        status = sm.solve_model(model)
+    finally:
+        model.integrality = integrality
+    return model.objective if status == 1 else None
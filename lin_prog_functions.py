@@ -3,13 +3,27 @@
 import numpy as np
 import global_variables as gv
 import testdata_proc as pf
+import sparse_model as sm
+import dense_profile as dp
+import feasibility as fs
+import heuristic as hr
+import timings as tm
+import solvers as slv
 import pandas as pd
 import datetime as dt
 from pulp import *
 import time
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 import cvxpy as cp
 from cvxopt.modeling import variable, op, max, sum
 
+TELEMETRY_COLS = ['variables', 'binaries', 'constraints', 'nonzeros',
+                  'build_time', 'solve_time', 'solve_path', 'solver_time',
+                  'overhead_time', 'cmd_overhead_time', 'gap', 'bound',
+                  'nodes']
+
+
 def optimise_range(empty_profile, charger, capacity,
                     dictV, batteries):
     """Linear optimisation for a range of dates with a mixed fleet
@@ -257,7 +271,7 @@ def linear_optimiser_V7(profile, ca, charger1, charger2,
     problem = cp.Problem(objective, constraints)
 
     # Solve and print to the screen
-    problem.solve(solver=cp.CBC)
+    slv.solve_cvxpy(problem)
 
     #print(problem.status)
     #print(ca, "status:", LpStatus[prob.status])
@@ -319,44 +333,123 @@ def linear_optimiser_V7(profile, ca, charger1, charger2,
 
 
 def optimise_range3(empty_profile, charger, capacity,
-                    dictV, batteries):
+                    dictV, batteries, optimiser=None, pipeline=None,
+                    horizon=None):
     """Linear optimisation for a range of dates with a mixed fleet
 
     Creates an output for each time period over a range of dates. Runs
     a linear optimisation over each day independently, passing the
-    final SOC to the next day.
+    final SOC to the next day. Collects the days of iter_range.
 
     Args:
-        empty_profile (DataFrame): MultiIndex profile of each vehicle
-                                    / time period
+        empty_profile (DataFrame or DenseProfile): MultiIndex profile
+            of each vehicle / time period
         charger (list): list of charger powers
         capacity (dict): dict. of max allowed site capacity per category
         dictV (dict): dictionary of vehicle IDs and model
+        optimiser (function): daily optimiser with the signature of
+            linear_optimiser_V6 (default)
+        pipeline (bool): prepare the next day in a worker thread,
+            gv.PIPELINE if None
+        horizon (int): days optimised together (rolling horizon),
+            gv.HORIZON if None
 
     Returns:
         DataFrame: power outputs for each vehicle / time period
         Array: list of dates in the time period
         String: list of dates when optimisation is unfeasible or there
                 are no journeys
-        LpProblem: the last optimisation problem
+        LpProblem: the last optimisation problem, None if every day is
+            empty
+        DataFrame: level of optimisation for each day
+        list: site battery outputs of each day / category
+        DataFrame: solver telemetry for each day / category, one row
+            per level solved (see level_telemetry)
     """
-    dates = np.unique(empty_profile.index.get_level_values(0).date)
-    vehiclelist = empty_profile.index.get_level_values(
-        'Vehicle_ID').unique()
-    nVeh = len(vehiclelist)
-    battery_cap = {k: gv.VSPEC[dictV[k]]['C'] for k in dictV.keys()}
     all_days_profile = []
+    PuLP_prob = None
     dates_status = pd.DataFrame(columns=gv.CATS)
     bad_days = '\nBad days:\n'
-    # status = 0
+    bat_out = []
+    telemetry = []
+    for res in iter_range(empty_profile, charger, capacity, dictV,
+                          batteries, optimiser, pipeline, horizon):
+        dates_status.loc[res.day] = pd.Series(res.status)
+        bad_days += res.bad_days
+        if res.profile is not None:
+            all_days_profile.append(res.profile)
+            bat_out += res.bats
+            PuLP_prob = res.probs
+            telemetry += res.telemetry
+    if all_days_profile:
+        profile_out = pd.concat(all_days_profile)
+    else:
+        profile_out = pd.DataFrame()  # Every day is empty
+    dates_status.rename(columns=gv.CAT_COLS['LEVEL'], inplace=True)
+    return (profile_out, res.dates, bad_days, PuLP_prob, dates_status,
+            bat_out, telemetry_frame(telemetry))
+
+
+def iter_range(empty_profile, charger, capacity,
+               dictV, batteries, optimiser=None, pipeline=None,
+               horizon=None):
+    """Optimises a range of dates one day at a time
+
+    Each day is yielded as soon as it's solved, so the outputs of the
+    whole range never have to be held in memory (see
+    output_functions.stream_outputs).
+
+    In pipelined mode a worker thread prepares the next day (daily
+    profile and, for linear_optimiser_V8, the whole sparse model) while
+    the current day is solving. Only the SOC dependent row bounds are
+    patched once the previous day's final SOC is known.
+
+    With a horizon of more than one day, each day is optimised together
+    with the following ones (linear_optimiser_window) and only its own
+    outputs are kept. The model of each day is built once and reused
+    by every window it's part of.
+
+    Args:
+        empty_profile (DataFrame or DenseProfile): MultiIndex profile
+            of each vehicle / time period
+        charger (list): list of charger powers
+        capacity (dict): dict. of max allowed site capacity per category
+        dictV (dict): dictionary of vehicle IDs and model
+        optimiser (function): daily optimiser with the signature of
+            linear_optimiser_V6 (default)
+        pipeline (bool): prepare the next day in a worker thread,
+            gv.PIPELINE if None
+        horizon (int): days optimised together, gv.HORIZON if None.
+            Above 1 the optimiser is always linear_optimiser_window
+
+    Yields:
+        SimpleNamespace: for each date, with attributes
+            day (datetime), dates (array of all dates),
+            profile (DataFrame of outputs, None on empty days),
+            status (dict of level per category), bats (list of battery
+            outputs), probs (dict of problems per category),
+            telemetry (list of level_telemetry rows per category) and
+            bad_days (str, the day's entry in the bad days list)
+    """
+    dense = isinstance(empty_profile, dp.DenseProfile)
+    if dense:
+        dates = empty_profile.calendar_dates()
+        vehiclelist = empty_profile.vehicles
+        req_energy = empty_profile.daily_use()*(1+gv.MARGIN_SOC)
+    else:
+        dates = np.unique(empty_profile.index.get_level_values(0).date)
+        vehiclelist = empty_profile.index.get_level_values(
+            'Vehicle_ID').unique()
+        req_energy = empty_profile.groupby(
+            ['date', 'Vehicle_ID']).sum()[['Battery_Use']]*(
+                1+gv.MARGIN_SOC)
+    nVeh = len(vehiclelist)
+    battery_cap = {k: gv.VSPEC[dictV[k]]['C'] for k in dictV.keys()}
     initial_rel_charge = pd.Series(
         data=[0]*nVeh,
-        index=empty_profile.index.get_level_values(1).unique()
+        index=vehiclelist
     )
     rel_charge = dict.fromkeys(gv.CATS, initial_rel_charge)
-    req_energy = empty_profile.groupby(
-        ['date', 'Vehicle_ID']).sum()[['Battery_Use']]*(
-            1+gv.MARGIN_SOC)
     print(req_energy)
     last_day = req_energy.index[-1][0]+dt.timedelta(days=1)
     for v in vehiclelist:
@@ -367,51 +460,84 @@ def optimise_range3(empty_profile, charger, capacity,
         'Battery_Use', 'Full_Use']].max(
         axis=1)
     print(req_energy)
-    level_optimiser = []
-    bat_out = []
-    for date in dates:
-        day_status = 0
-        start = time.process_time()
+    if optimiser is None:
+        optimiser = linear_optimiser_V6
+    if pipeline is None:
+        pipeline = gv.PIPELINE
+    if horizon is None:
+        horizon = gv.HORIZON
+    soc_form = None
+    if horizon > 1:
+        optimiser = linear_optimiser_window
+        soc_form = 'state'
+    prebuild = optimiser in (linear_optimiser_V8, linear_optimiser_window)
+
+    def prepare(date):
         day = dt.datetime.combine(date, dt.datetime.min.time())
-        day_profile = pf.create_daily_schedule(empty_profile, day)
-        if len(day_profile) == 0:
-            bad_days += '\nEmpty day:'
-            bad_days += str(date)
-            dates_status.loc[day] = 'Empty'
-            pass
-        else:
+        return prepare_day(empty_profile, day, charger, capacity,
+                           battery_cap, prebuild, soc_form)
+
+    # Prepared days (futures when pipelined) by position in dates
+    prepared = {}
+
+    def submit(j):
+        if j not in prepared:
+            prepared[j] = (worker.submit(prepare, dates[j]) if pipeline
+                           else prepare(dates[j]))
+
+    def fetch(j):
+        submit(j)
+        return prepared[j].result() if pipeline else prepared[j]
+
+    if pipeline:
+        worker = ThreadPoolExecutor(max_workers=1)
+    try:
+        for i, date in enumerate(dates):
+            day_status = 0
+            day = dt.datetime.combine(date, dt.datetime.min.time())
+            day_profile, day_profile_out, built = fetch(i)
+            window = [built]
+            for j in range(i + 1, min(i + horizon, len(dates))):
+                if fetch(j)[2] is None:
+                    break  # Empty day
+                window.append(fetch(j)[2])
+            if pipeline and i + horizon < len(dates):
+                submit(i + horizon)
+            del prepared[i]
+            if len(day_profile) == 0:
+                yield SimpleNamespace(
+                    day=day, dates=dates, profile=None,
+                    status=dict.fromkeys(gv.CATS, 'Empty'), bats=[],
+                    probs={}, telemetry=[],
+                    bad_days='\nEmpty day:' + str(date))
+                continue
             next_day = day+dt.timedelta(days=1)
             next_req = req_energy.loc[
                 (next_day, slice(None)), 'Req_Battery'].droplevel(level=0)
             output_df = {}
             PuLP_prob = {}
             bat_df = {}
-            day_profile_out = day_profile.copy()
-            day_level = []
+            day_level = {}
+            bad_days = ''
             for ca in gv.CATS:
-                # print(charger[0])
-                # print(charger[-1])
+                if horizon > 1:
+                    kwargs = {'window': [b[ca] for b in window]}
+                else:
+                    kwargs = {'built': built[ca]} if built else {}
                 (output_df[ca], PuLP_prob[ca], rel_charge[ca], note,
-                    dates_status.loc[day, ca], bat_df[ca]) = linear_optimiser_V6(
+                    day_level[ca], bat_df[ca]) = optimiser(
                     day_profile, ca,
                     charger[0], charger[-1],
                     capacity[ca], rel_charge[ca], next_req,
-                    battery_cap)
+                    battery_cap, **kwargs)
                 day_profile_out = day_profile_out.merge(
                     output_df[ca],
                     how='left',
                     left_index=True,
                     right_index=True,
                     )
-                bat_out.append(bat_df[ca])
                 day_profile_out.fillna(0, inplace=True)
                 day_status += PuLP_prob[ca].status
-            # print(
-            #     date,
-            #     # '\nTime:', time.process_time() - start,
-            #     'Status:', day_status,
-            #     ':', PuLP_prob[gv.CATS[0]].status)
-            all_days_profile.append(day_profile_out)
             if day_status < len(gv.CATS):
                 bad_days += '\nNon-Optimal: '
                 bad_days += str(date)
@@ -419,9 +545,283 @@ def optimise_range3(empty_profile, charger, capacity,
                 for ca in gv.CATS:
                     bad_days += '_'
                     bad_days += str(PuLP_prob[ca].status)
+            telemetry = [
+                dict(date=day, category=ca, **row) for ca in gv.CATS
+                for row in level_telemetry(PuLP_prob[ca], day_level[ca])]
+            yield SimpleNamespace(
+                day=day, dates=dates, profile=day_profile_out,
+                status=day_level, bats=[bat_df[ca] for ca in gv.CATS],
+                probs=PuLP_prob, telemetry=telemetry, bad_days=bad_days)
+    finally:
+        if pipeline:
+            worker.shutdown()
+
+
+def optimise_range_model(empty_profile, charger, capacity,
+                         dictV, batteries, time_limit=None, gap=None):
+    """Linear optimisation of a whole range of dates as a single model
+
+    The models of every day, in the 'state' SOC form, are linked by
+    their SOC across each midnight (sparse_model.link_days) and solved
+    as one MILP: only the range has to end full, not every day. The
+    model grows linearly with the number of days. Meant for offline
+    studies over a few weeks; its bound is a lower bound on the energy
+    cost of the daily modes when every day is at Main level. If the
+    range can't be solved, it's optimised day by day instead
+    (optimise_range3 with linear_optimiser_V8).
+
+    Args:
+        empty_profile (DataFrame or DenseProfile): MultiIndex profile
+            of each vehicle / time period
+        charger (list): list of charger powers
+        capacity (dict): dict. of max allowed site capacity per category
+        dictV (dict): dictionary of vehicle IDs and model
+        time_limit (float): seconds for the whole solve,
+            gv.SOLVER_TIME_LIMIT if None
+        gap (float): relative MIP gap, gv.SOLVER_GAP if None
+
+    Returns:
+        Same as optimise_range3, with the range model of each category
+        as problem and one telemetry row per category (on the first day)
+        (None and no rows if every day is empty)
+    """
+    if isinstance(empty_profile, dp.DenseProfile):
+        dates = empty_profile.calendar_dates()
+    else:
+        dates = np.unique(empty_profile.index.get_level_values(0).date)
+    battery_cap = {k: gv.VSPEC[dictV[k]]['C'] for k in dictV.keys()}
+    days = []
+    dates_status = pd.DataFrame(columns=gv.CATS)
+    bad_days = '\nBad days:\n'
+    for date in dates:
+        day = dt.datetime.combine(date, dt.datetime.min.time())
+        day_profile, day_profile_out, built = prepare_day(
+            empty_profile, day, charger, capacity, battery_cap,
+            prebuild=True, soc_form='state')
+        if len(day_profile) == 0:
+            dates_status.loc[day] = pd.Series(
+                dict.fromkeys(gv.CATS, 'Empty'))
+            bad_days += '\nEmpty day:' + str(date)
+            continue
+        days.append((day, day_profile_out, built))
+    if not days:
+        # Nothing to link, same result as the daily mode
+        return (pd.DataFrame(), dates, bad_days, None,
+                dates_status.sort_index().rename(
+                    columns=gv.CAT_COLS['LEVEL']),
+                [], telemetry_frame([]))
+
+    models = {}
+    for ca in gv.CATS:
+        model = sm.link_days([built[ca][1] for _, _, built in days])
+        model.build_time += np.sum([built[ca][1].build_time
+                                    for _, _, built in days])
+        vehicles = days[0][2][ca][0]['vehicles']
+        sm.set_rel_charge(model, np.zeros(len(vehicles)))
+        with slv.limits(time_limit, gap):
+            sm.solve_model(model)
+        if model.status != 1:
+            print(ca, 'Whole range unfeasible, optimising day by day')
+            return optimise_range3(empty_profile, charger, capacity,
+                                   dictV, batteries,
+                                   optimiser=linear_optimiser_V8)
+        print(ca, 'Range objective: {:.2f}, bound: {:.2f}'.format(
+            model.objective, model.bound if model.bound is not None
+            else model.objective))
+        sm.split_days(model)
+        models[ca] = model
+
+    all_days_profile = []
+    bat_out = []
+    for day, day_profile_out, built in days:
+        for ca in gv.CATS:
+            arrays, day_model = built[ca]
+            df, dfb = sm.model_outputs(
+                day_model, arrays, gv.CAT_COLS['OUTPUT'][ca],
+                gv.CAT_COLS['CH_TYPE'][ca])
+            day_profile_out = day_profile_out.merge(
+                df, how='left', left_index=True, right_index=True)
+            day_profile_out.fillna(0, inplace=True)
+            bat_out.append(dfb)
+        all_days_profile.append(day_profile_out)
+        dates_status.loc[day] = pd.Series(dict.fromkeys(gv.CATS, 'Main'))
     profile_out = pd.concat(all_days_profile)
-    dates_status.rename(columns=gv.CAT_COLS['LEVEL'], inplace=True)
-    return profile_out, dates, bad_days, PuLP_prob, dates_status, bat_out
+    dates_status = dates_status.sort_index().rename(
+        columns=gv.CAT_COLS['LEVEL'])
+    telemetry = [
+        dict(date=days[0][0], category=ca, level='Main',
+             status=models[ca].status, **solver_telemetry(models[ca]))
+        for ca in gv.CATS]
+    return (profile_out, dates, bad_days, models, dates_status, bat_out,
+            telemetry_frame(telemetry))
+
+
+def solver_telemetry(prob):
+    """Size and solve statistics of a daily problem
+
+    Args:
+        prob (LpProblem or SparseModel): problem returned by the daily
+            optimiser
+
+    Returns:
+        dict: variables, binaries, constraints, nonzeros, build_time and
+            solve_time (s), solve_path ('in-process' or 'subprocess'),
+            solver_time (s, reported by the solver) and overhead_time
+            (solve_time - solver_time: model export, process start, file
+            and solution parsing), cmd_overhead_time (overhead of the
+            subprocess path, sampled on in-process PuLP solves, see
+            solvers.cmd_overhead), gap (relative MIP gap), bound (lower
+            bound on the objective) and nodes (branch and bound), None
+            where the solver doesn't report them
+    """
+    info = dict.fromkeys(TELEMETRY_COLS)
+    if isinstance(prob, sm.SparseModel):
+        info.update(
+            variables=prob.num_variables(),
+            binaries=int(prob.integrality.sum()),
+            constraints=prob.num_constraints(),
+            nonzeros=prob.A.nnz,
+            build_time=prob.build_time,
+            solve_time=prob.solve_time,
+            solve_path=prob.solve_path,
+            solver_time=prob.solver_time,
+            gap=prob.gap,
+            bound=prob.bound,
+            nodes=prob.nodes)
+    elif isinstance(prob, LpProblem):
+        variables = prob.variables()
+        info.update(
+            variables=len(variables),
+            binaries=len([v for v in variables if v.cat == LpInteger]),
+            constraints=len(prob.constraints),
+            nonzeros=int(np.sum(
+                [len(c) for c in prob.constraints.values()])),
+            build_time=getattr(prob, 'build_time', None),
+            solve_time=prob.solutionTime,
+            solve_path=getattr(prob, 'solve_path', None),
+            solver_time=getattr(prob, 'solver_time', None),
+            cmd_overhead_time=getattr(prob, 'cmd_overhead_time', None),
+            gap=getattr(prob, 'gap', None),
+            bound=getattr(prob, 'bound', None),
+            nodes=getattr(prob, 'nodes', None))
+    if info['solve_time'] is not None and info['solver_time'] is not None:
+        info['overhead_time'] = info['solve_time'] - info['solver_time']
+    return info
+
+
+def record_attempt(prob, level, build_time):
+    """Adds the telemetry of the solve just made at a level to
+    prob.attempts
+
+    Args:
+        prob (LpProblem or SparseModel): problem of the daily optimiser
+        level (str): level of the solve (see feasibility.LEVELS)
+        build_time (float): time to build the problem or switch it to
+            the level (s)
+    """
+    info = solver_telemetry(prob)
+    if isinstance(prob, sm.SparseModel):
+        # The model's solve times add up over its levels
+        for col in ['solve_time', 'solver_time']:
+            done = [a[col] for a in prob.attempts]
+            if info[col] is not None and None not in done:
+                info[col] -= np.sum(done)
+        if info['solver_time'] is not None:
+            info['overhead_time'] = info['solve_time'] - info['solver_time']
+    info.update(level=level, status=prob.status, build_time=build_time)
+    prob.attempts.append(info)
+
+
+def level_telemetry(prob, level):
+    """Telemetry rows of a day / category
+
+    Args:
+        prob (LpProblem or SparseModel): problem of the daily optimiser
+        level (str): level of optimisation that was feasible
+
+    Returns:
+        list: one solver_telemetry row (with level and status) per level
+            solved, or a single row for the final level if the
+            optimiser doesn't record them (see record_attempt)
+    """
+    attempts = getattr(prob, 'attempts', None)
+    if attempts:
+        return attempts
+    return [dict(level=level, status=prob.status, **solver_telemetry(prob))]
+
+
+def telemetry_frame(rows):
+    """Telemetry rows of iter_range as a (date, category) table"""
+    df = pd.DataFrame(rows, columns=['date', 'category', 'level', 'status']
+                      + TELEMETRY_COLS)
+    return df.set_index(['date', 'category'])
+
+
+def solve_overhead(telemetry):
+    """Solve time of a run split between the solver and the overhead
+
+    Also gives the overhead the subprocess path has, or would have had,
+    for the same solves: measured on the subprocess path, estimated from
+    the sampled solves (solvers.cmd_overhead) on the in-process path, so
+    an in-process run shows its saving side by side.
+
+    Args:
+        telemetry (DataFrame): output of telemetry_frame
+
+    Returns:
+        DataFrame: solves, solve_time, solver_time, overhead_time,
+            cmd_overhead_time and saving (cmd_overhead_time -
+            overhead_time) (s) per solve_path, NaN where no solve was
+            sampled
+    """
+    summary = telemetry.groupby('solve_path').agg(
+        solves=('solve_time', 'count'), solve_time=('solve_time', 'sum'),
+        solver_time=('solver_time', 'sum'),
+        overhead_time=('overhead_time', 'sum'),
+        cmd_overhead_time=('cmd_overhead_time', 'mean'))
+    summary['cmd_overhead_time'] *= summary['solves']
+    subprocess = summary.index == 'subprocess'
+    summary.loc[subprocess, 'cmd_overhead_time'] = summary.loc[
+        subprocess, 'overhead_time']
+    summary['saving'] = (summary['cmd_overhead_time']
+                         - summary['overhead_time'])
+    return summary
+
+
+def prepare_day(empty_profile, day, charger, capacity, battery_cap,
+                prebuild=False, soc_form=None):
+    """Everything about a day that doesn't depend on the initial SOC
+
+    Args:
+        empty_profile (DataFrame or DenseProfile): MultiIndex profile
+            of each vehicle / time period
+        day (datetime): day to prepare
+        charger (list): list of charger powers
+        capacity (dict): dict. of max allowed site capacity per category
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        prebuild (bool): also build the linear_optimiser_V8 model of
+            each category
+        soc_form (str): SOC formulation of the models, gv.SOC_FORM if
+            None
+
+    Returns:
+        DataFrame or DenseDay: empty profile of the day
+        DataFrame: copy of the profile to merge outputs into
+        dict: category: (arrays, SparseModel), None if not prebuilt
+    """
+    if isinstance(empty_profile, dp.DenseProfile):
+        day_profile = empty_profile.day(day)  # view, no copy
+    else:
+        day_profile = pf.create_daily_schedule(empty_profile, day)
+    if len(day_profile) == 0:
+        return day_profile, None, None
+    built = None
+    if prebuild:
+        built = {
+            ca: build_day_V8(day_profile, ca, charger[0], charger[-1],
+                             capacity[ca], battery_cap, soc_form)
+            for ca in gv.CATS}
+    return day_profile, dp.as_frame(day_profile).copy(), built
 
 
 def charge_tonextday(profile, ca, charger1, charger2,
@@ -502,32 +902,7 @@ def charge_tonextday(profile, ca, charger1, charger2,
         )
     #print('well!')
     # Intermediate SOC constraints
-    for vehicle in vehicles:
-        vehicle_prof = profile_av.loc[(slice(None), vehicle), 'Battery_Use']
-        for period in vehicle_prof.index.get_level_values(0):
-            cumul_use = profile.loc[(slice(period), vehicle),
-                                    'Battery_Use'].sum()
-            cumul_profile = profile_av.loc[(slice(period), vehicle),
-                                           'Battery_Use']
-            prob += lpSum(  # Doesn't go over 100% SOC
-                [outputs[period, vehicle] * gv.CHARGER_EFF
-                    for period, vehicle in cumul_profile.index]
-            ) + cumul_use + rel_charge[vehicle] <= 0.00001
-        # Make sure it doesn't go below 0% SOC at every return
-        profile_ret = profile[profile['Return'] == 1]
-        #print('heh')
-        
-        if vehicle in profile_ret.index.get_level_values('Vehicle_ID'):
-            returns = profile_ret.loc[(slice(None), vehicle), 'Battery_Use']
-            for period in returns.index.get_level_values(0):
-                cumul_use = profile.loc[(slice(period), vehicle),
-                                        'Battery_Use'].sum()
-                cumul_profile = profile_av.loc[
-                    (slice(period), vehicle), 'Battery_Use']
-                prob += lpSum(  # Doesn't go below 0% SOC
-                    [outputs[period, v] * gv.CHARGER_EFF
-                        for period, v in cumul_profile.index]
-                ) + cumul_use + rel_charge[vehicle] + battery_cap[vehicle] >= 0
+    soc_constraints(prob, outputs, profile, rel_charge, battery_cap)
 
     # Max capacity constraint
     n = len(time_periods.unique())
@@ -542,7 +917,7 @@ def charge_tonextday(profile, ca, charger1, charger2,
                 for v in time_veh]) <= gv.NUM_FAST_CH
 
     # Solve and print to the screen
-    prob.solve()
+    slv.solve_pulp(prob)
     print(ca, "Next required charge status:", LpStatus[prob.status])
     if prob.status == -1:
         print('Breach!')
@@ -661,30 +1036,7 @@ def charge_tonextday_breach(profile, ca, charger1, charger2,
         )
 
     # Intermediate SOC constraints
-    for vehicle in vehicles:
-        vehicle_prof = profile_av.loc[(slice(None), vehicle), 'Battery_Use']
-        for period in vehicle_prof.index.get_level_values(0):
-            cumul_use = profile.loc[(slice(period), vehicle),
-                                    'Battery_Use'].sum()
-            cumul_profile = profile_av.loc[(slice(period), vehicle),
-                                           'Battery_Use']
-            prob += lpSum(  # Doesn't go over 100% SOC
-                [outputs[period, vehicle] * gv.CHARGER_EFF
-                    for period, vehicle in cumul_profile.index]
-            ) + cumul_use + rel_charge[vehicle] <= 0.00001
-        # Make sure it doesn't go below 0% SOC at every return
-        profile_ret = profile[profile['Return'] == 1]
-        if vehicle in profile_ret.index.get_level_values('Vehicle_ID'):
-            returns = profile_ret.loc[(slice(None), vehicle), 'Battery_Use']
-            for period in returns.index.get_level_values(0):
-                cumul_use = profile.loc[(slice(period), vehicle),
-                                        'Battery_Use'].sum()
-                cumul_profile = profile_av.loc[
-                    (slice(period), vehicle), 'Battery_Use']
-                prob += lpSum(  # Doesn't go below 0% SOC
-                    [outputs[period, v] * gv.CHARGER_EFF
-                        for period, v in cumul_profile.index]
-                ) + cumul_use + rel_charge[vehicle] + battery_cap[vehicle] >= 0
+    soc_constraints(prob, outputs, profile, rel_charge, battery_cap)
 
     n = len(time_periods.unique())
     for period in time_periods:
@@ -697,7 +1049,7 @@ def charge_tonextday_breach(profile, ca, charger1, charger2,
                 for v in time_veh]
             ) <= gv.NUM_FAST_CH
 
-    prob.solve()
+    slv.solve_pulp(prob)
     print(ca, "Next required charge with breach status:",
           LpStatus[prob.status])
     if prob.status == -1:
@@ -720,7 +1072,7 @@ def charge_tonextday_breach(profile, ca, charger1, charger2,
                 y = 0
             var_output = {
                 'from': period,
-                'Vehicle_ID': route,
+                'Vehicle_ID': vehicle,
                 output_col: x,
                 ch_col: y
             }
@@ -794,24 +1146,14 @@ def charge_incomplete(profile, ca, charger1, charger2,
             * gv.TIME_FRACT)
 
     # Intermediate SOC constraints
-    for vehicle in vehicles:
-        vehicle_prof = profile_av.loc[(slice(None), vehicle), 'Battery_Use']
-        for period in vehicle_prof.index.get_level_values(0):
-            cumul_use = profile.loc[
-                (slice(period), vehicle), 'Battery_Use'].sum()
-            cumul_profile = profile_av.loc[
-                (slice(period), vehicle), 'Battery_Use']
-            prob += lpSum(  # Doesn't go over 100% SOC
-                [outputs[period, vehicle] * gv.CHARGER_EFF
-                    for period, vehicle in cumul_profile.index]
-            ) + cumul_use + rel_charge[vehicle] <= 0
-            prob += (lpSum(  # Doesn't go below 0% SOC
-                [outputs[period, v] * gv.CHARGER_EFF
-                    for period, v in cumul_profile.index])
-                + cumul_use + rel_charge[vehicle]
-                >= (-battery_cap[vehicle] + gv.TIME_FRACT * (charger1
-                    + ch_assignment[profile_av.loc[(period, vehicle),
-                                    'Session']] * (charger2-charger1))))
+    soc = soc_constraints(prob, outputs, profile, rel_charge, None,
+                          upper=0, returns=False)
+    for period, vehicle in profile_av.index:
+        prob += (soc[period, vehicle]  # Doesn't go below 0% SOC
+                 >= (-battery_cap[vehicle] + gv.TIME_FRACT * (
+                     charger1 + ch_assignment[profile_av.loc[
+                         (period, vehicle), 'Session']]
+                     * (charger2-charger1))))
 
     # Max capacity constraint
     n = len(time_periods.unique())
@@ -824,7 +1166,7 @@ def charge_incomplete(profile, ca, charger1, charger2,
                 for vehicle in time_veh]) <= gv.NUM_FAST_CH
 
     # Solve and print to the screen
-    prob.solve()
+    slv.solve_pulp(prob)
     print(ca, "Partial charge status:", LpStatus[prob.status])
     if prob.status == -1:
         print('Magic!!')
@@ -854,6 +1196,132 @@ def charge_incomplete(profile, ca, charger1, charger2,
     return df
 
 
+def soc_state_constraints(prob, outputs, profile, rel_charge, battery_cap,
+                          upper=0.00001, returns=True):
+    """Intermediate SOC constraints with one SOC variable per time period
+
+    Linear-size alternative to the cumulative sums: each vehicle gets a
+    SOC variable (relative to full) per time period, linked to the
+    previous period by a one-step balance. This gives O(T) non-zeros
+    per vehicle instead of O(T^2). Used when gv.SOC_FORM is 'state'.
+
+    Args:
+        prob (LpProblem): problem to add the constraints to
+        outputs (dict): output variables, keyed by (period, vehicle)
+        profile (DataFrame): empty profile of a single day
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        upper (float): max SOC relative to full when plugged in
+        returns (bool): add the 0% SOC constraint at every return
+
+    Returns:
+        dict: SOC variables, keyed by (period, vehicle)
+    """
+    soc = LpVariable.dicts(
+        "soc",
+        ((period, vehicle) for period, vehicle in profile.index),
+        cat='Continuous')
+    vehicles = profile.index.get_level_values(1).unique()
+    for vehicle in vehicles:
+        vehicle_prof = profile.xs(vehicle, level='Vehicle_ID')
+        previous = rel_charge[vehicle]
+        for period, available, use, ret in zip(
+                vehicle_prof.index, vehicle_prof['Available'],
+                vehicle_prof['Battery_Use'], vehicle_prof['Return']):
+            delivered = 0
+            if available == 1:
+                delivered = outputs[period, vehicle] * gv.CHARGER_EFF
+            prob += soc[period, vehicle] == previous + use + delivered
+            if available == 1:
+                prob += soc[period, vehicle] <= upper  # Not over 100% SOC
+            if returns and ret == 1:
+                prob += soc[period, vehicle] + battery_cap[vehicle] >= 0
+            previous = soc[period, vehicle]
+    return soc
+
+
+def soc_cumulative_constraints(prob, outputs, profile, rel_charge,
+                               battery_cap, upper=0.00001, returns=True):
+    """Intermediate SOC constraints as cumulative sums of the outputs
+
+    The SOC at each available period is the sum of all outputs and
+    battery use up to that period. Used when gv.SOC_FORM is 'cumulative'.
+
+    Args:
+        prob (LpProblem): problem to add the constraints to
+        outputs (dict): output variables, keyed by (period, vehicle)
+        profile (DataFrame): empty profile of a single day
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        upper (float): max SOC relative to full when plugged in
+        returns (bool): add the 0% SOC constraint at every return
+
+    Returns:
+        dict: SOC expressions at available periods, keyed by
+            (period, vehicle)
+    """
+    profile_av = profile[profile['Available'] == 1]
+    profile_ret = profile[profile['Return'] == 1]
+    soc = {}
+    vehicles = profile.index.get_level_values(1).unique()
+    for vehicle in vehicles:
+        vehicle_prof = profile_av.loc[(slice(None), vehicle), 'Battery_Use']
+        for period in vehicle_prof.index.get_level_values(0):
+            cumul_use = profile.loc[(slice(period), vehicle),
+                                    'Battery_Use'].sum()
+            cumul_profile = profile_av.loc[(slice(period), vehicle),
+                                           'Battery_Use']
+            soc[period, vehicle] = lpSum(
+                [outputs[p, v] * gv.CHARGER_EFF
+                    for p, v in cumul_profile.index]
+            ) + cumul_use + rel_charge[vehicle]
+            prob += soc[period, vehicle] <= upper  # Not over 100% SOC
+        # Make sure it doesn't go below 0% SOC at every return
+        if (returns and vehicle
+                in profile_ret.index.get_level_values('Vehicle_ID')):
+            ret = profile_ret.loc[(slice(None), vehicle), 'Battery_Use']
+            for period in ret.index.get_level_values(0):
+                cumul_use = profile.loc[(slice(period), vehicle),
+                                        'Battery_Use'].sum()
+                cumul_profile = profile_av.loc[(slice(period), vehicle),
+                                               'Battery_Use']
+                prob += lpSum(  # Doesn't go below 0% SOC
+                    [outputs[p, v] * gv.CHARGER_EFF
+                        for p, v in cumul_profile.index]
+                ) + (cumul_use + rel_charge[vehicle]
+                     + battery_cap[vehicle]) >= 0
+    return soc
+
+
+def soc_constraints(prob, outputs, profile, rel_charge, battery_cap,
+                    upper=0.00001, returns=True):
+    """Intermediate SOC constraints in the gv.SOC_FORM formulation
+
+    See soc_state_constraints and soc_cumulative_constraints.
+
+    Args:
+        prob (LpProblem): problem to add the constraints to
+        outputs (dict): output variables, keyed by (period, vehicle)
+        profile (DataFrame): empty profile of a single day
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        upper (float): max SOC relative to full when plugged in
+        returns (bool): add the 0% SOC constraint at every return
+
+    Returns:
+        dict: SOC variables or expressions, keyed by (period, vehicle),
+            at least for every available period
+    """
+    if gv.SOC_FORM == 'state':
+        return soc_state_constraints(prob, outputs, profile, rel_charge,
+                                     battery_cap, upper, returns)
+    return soc_cumulative_constraints(prob, outputs, profile, rel_charge,
+                                      battery_cap, upper, returns)
+
+
 def magic_charging(profile, ca, rel_charge):
     """Special charging profile
 
@@ -884,6 +1352,211 @@ def magic_charging(profile, ca, rel_charge):
     return profile_av[[output_col]]
 
 
+def charge_cascade(profile, ca, charger1, charger2, capacity,
+                   rel_charge, next_req, battery_cap, built=None,
+                   start_level='Tonext'):
+    """Fallback levels Tonext -> Breach -> Magic on a single model
+
+    Same levels as charge_tonextday and charge_tonextday_breach, but
+    the sparse model is built once and switched to each level with
+    sparse_model.set_level instead of being rebuilt.
+
+    Args:
+        profile (DataFrame or DenseDay): empty profile of a single day
+        ca (str): category to use in optimisation (opt, BAU)
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        capacity (Series): max allowed site capacity per time period
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        next_req (Series): battery requirements for next day per vehicle
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        built (tuple): (arrays, model) of the unfeasible Main model,
+            built here if None
+        start_level (str): first level to try, earlier ones are
+            known to be unfeasible (see feasibility.screen_day)
+
+    Returns:
+        DataFrame: outputs per time period
+        DataFrame: site battery outputs for each time period
+        str: note about the optimisation
+        opt_level (str)
+    """
+    output_col = gv.CAT_COLS['OUTPUT'][ca]
+    ch_col = gv.CAT_COLS['CH_TYPE'][ca]
+    start = time.perf_counter()
+    if built is None:
+        built = build_day_V8(profile, ca, charger1, charger2, capacity,
+                             battery_cap)
+        print(ca, 'Fallback model built in {:.2f}s'.format(
+            time.perf_counter() - start))
+    arrays, model = built
+    vehicles = arrays['vehicles']
+    caps = [battery_cap[v] for v in vehicles]
+    reqs = next_req.loc[vehicles].values
+    if model.rel_charge is None:
+        sm.set_rel_charge(model, rel_charge.loc[vehicles].values)
+    note = ''
+    levels = fs.LEVELS[fs.LEVELS.index(start_level):-1]
+    if start_level == 'Breach':
+        note += '\nBreach!'
+    elif start_level == 'Magic':
+        note += '\nBreach!\nMagic!'
+        model.status = -1
+    for level in levels:
+        previous = model.level
+        start = time.perf_counter()
+        with tm.stage('level_' + level):
+            sm.set_level(model, level, reqs, caps)
+            switch_time = time.perf_counter() - start
+            sm.solve_model(model, warm_start=True)
+        if not model.attempts:
+            switch_time += model.build_time  # Main was screened out
+        record_attempt(model, level, switch_time)
+        print(ca, previous, '->', level, 'status:', LpStatus[model.status],
+              '({:.2f}s)'.format(time.perf_counter() - start))
+        if model.status != -1:
+            break
+        note += '\nBreach!' if level == 'Tonext' else '\nMagic!'
+    df, dfb = sm.model_outputs(model, arrays, output_col, ch_col)
+    if model.status == -1:
+        with tm.stage('level_Magic'):
+            df = magic_charging(dp.as_frame(profile), ca, rel_charge)
+        return df, dfb, note, 'Magic'
+    if level == 'Breach':
+        print(int(model.x[model.cols['breach']].round().sum()),
+              'breaches')
+    print('Cost:', model.objective)
+    return df, dfb, note, level
+
+
+def set_pulp_level(prob, parts, level, next_req, battery_cap):
+    """Switches the linear_optimiser_V6 problem to a fallback level
+
+    As sparse_model.set_level, for the PuLP problem: Tonext (as
+    charge_tonextday) rewards every kWh delivered (price - 100) and only
+    asks for enough charge for the next day's journeys. Breach (as
+    charge_tonextday_breach) also adds a binary per period that doubles
+    the site capacity at a cost of 1000. The constraints are changed in
+    place, so the problem is never rebuilt.
+
+    Args:
+        prob (LpProblem): problem built by linear_optimiser_V6
+        parts (SimpleNamespace): its variables and the constraints the
+            levels change (see linear_optimiser_V6)
+        level (str): 'Tonext' or 'Breach'
+        next_req (Series): battery requirements for next day per vehicle
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+    """
+    profile_av = parts.profile_av
+    if prob.level == 'Main':
+        prob.setObjective(lpSum(
+            [(profile_av.loc[(period, vehicle), parts.price_col] - 100)
+                * parts.outputs[period, vehicle]
+                for period, vehicle in profile_av.index]))
+        for key in parts.outputs.keys() - set(profile_av.index):
+            parts.outputs[key].upBound = 0  # Away, not rewarded
+    for vehicle, constraint in parts.final.items():
+        # End of day SOC >= -(capacity + next requirements), instead of 0
+        need = battery_cap[vehicle] + next_req.loc[vehicle]
+        if level == 'Breach':
+            need -= 0.00001
+        constraint.sense = LpConstraintGE
+        constraint.changeRHS(parts.main_final_rhs[vehicle] - need)
+    if level == 'Breach' and prob.level != 'Breach':
+        parts.breaches = LpVariable.dicts(
+            "Breach", (period for period in parts.site), cat='Binary')
+        for period, constraint in parts.site.items():
+            constraint.addInPlace(
+                -parts.capacity.loc[period] * gv.TIME_FRACT
+                * parts.breaches[period])
+        prob.setObjective(
+            prob.objective + 1000 * lpSum(parts.breaches.values()))
+    prob.level = level
+
+
+def pulp_cascade(prob, parts, profile, ca, rel_charge, next_req,
+                 battery_cap, start_level='Tonext'):
+    """Fallback levels Tonext -> Breach -> Magic on the V6 problem
+
+    Same levels as charge_tonextday and charge_tonextday_breach, on the
+    problem of linear_optimiser_V6, switched to each level with
+    set_pulp_level instead of being rebuilt, and solved with the same
+    backend as Main. Each solve starts from the previous one's values.
+    The site battery is not used at these levels.
+
+    Args:
+        prob (LpProblem): problem built by linear_optimiser_V6
+        parts (SimpleNamespace): its variables and the constraints the
+            levels change
+        profile (DataFrame): empty profile of a single day
+        ca (str): category to use in optimisation (opt, BAU)
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        next_req (Series): battery requirements for next day per vehicle
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        start_level (str): first level to try, earlier ones are
+            known to be unfeasible (see feasibility.screen_day)
+
+    Returns:
+        DataFrame: outputs per time period
+        DataFrame: site battery outputs for each time period (empty)
+        str: note about the optimisation
+        opt_level (str)
+    """
+    output_col = gv.CAT_COLS['OUTPUT'][ca]
+    ch_col = gv.CAT_COLS['CH_TYPE'][ca]
+    dfb = pd.DataFrame(columns=['from', 'Battery_ID', output_col])
+    note = ''
+    levels = fs.LEVELS[fs.LEVELS.index(start_level):-1]
+    if start_level == 'Breach':
+        note += '\nBreach!'
+    elif start_level == 'Magic':
+        note += '\nBreach!\nMagic!'
+    for level in levels:
+        previous = prob.level
+        start = time.perf_counter()
+        with tm.stage('level_' + level):
+            set_pulp_level(prob, parts, level, next_req, battery_cap)
+            switch_time = time.perf_counter() - start
+            slv.solve_pulp(prob, warm_start=True)
+        if not prob.attempts:
+            switch_time += prob.build_time  # Main was screened out
+        record_attempt(prob, level, switch_time)
+        print(ca, previous, '->', level, 'status:', LpStatus[prob.status],
+              '({:.2f}s)'.format(time.perf_counter() - start))
+        if prob.status != -1:
+            break
+        note += '\nBreach!' if level == 'Tonext' else '\nMagic!'
+    if not levels or prob.status == -1:
+        with tm.stage('level_Magic'):
+            df = magic_charging(profile, ca, rel_charge)
+        return df, dfb, note, 'Magic'
+    charge_output = []
+    for period, vehicle in parts.profile_av.index:
+        if prob.status == 1:
+            x = parts.outputs[period, vehicle].varValue
+            y = parts.ch_assignment[parts.profile_av.loc[
+                (period, vehicle), 'Session']].varValue
+        else:
+            x = 0
+            y = 0
+        charge_output.append({
+            'from': period,
+            'Vehicle_ID': vehicle,
+            output_col: x,
+            ch_col: y
+        })
+    df = pd.DataFrame.from_records(charge_output).sort_values(
+        ['from', 'Vehicle_ID'])
+    df.set_index(['from', 'Vehicle_ID'], inplace=True)
+    if level == 'Breach':
+        print(int(np.sum([b.varValue or 0 for b in
+                          parts.breaches.values()])), 'breaches')
+    print('Cost:', value(prob.objective))
+    return df, dfb, note, level
+
+
 def linear_optimiser_V6(profile, ca, charger1, charger2,
                         capacity, rel_charge, next_req, battery_cap):
     """Linear optimisation for a single day charging, mixed fleet
@@ -895,11 +1568,11 @@ def linear_optimiser_V6(profile, ca, charger1, charger2,
         of next day departures
     Constraint 2: not go below 0% or over 100% battery charge
     Constraint 3: not go over site capacity
-    If this is unfeasible, it will atempt to charge as much as possible
-    using incomplete_charge.
+    If this is unfeasible, the same problem goes through the fallback
+    levels of pulp_cascade.
 
     Args:
-        profile (DataFrame): empty profile of a single day
+        profile (DataFrame or DenseDay): empty profile of a single day
         ca (str): category to use in optimisation (opt, BAU)
         charger1 (int): slow charger power
         charger2 (int): fast charger power
@@ -911,11 +1584,13 @@ def linear_optimiser_V6(profile, ca, charger1, charger2,
 
     Returns:
         DataFrame: Outputs for each time period
-        LpProblem: variables, objective and constraints
+        LpProblem: variables, objective and constraints, at the last
+            level tried, with the status of Main
         Series: end of day final SOC for each vehicle
         str: a note on outcomes of the daily optimisation
         opt_level (str): the level of optimisation that was feasible
     """
+    profile = dp.as_frame(profile)
     #print(profile)
     vehicles = profile.index.get_level_values(1).unique()
     #print(profile.loc[profile['Return'] == 1])
@@ -928,8 +1603,14 @@ def linear_optimiser_V6(profile, ca, charger1, charger2,
     #print(price_col)
     output_col = gv.CAT_COLS['OUTPUT'][ca]
     ch_col = gv.CAT_COLS['CH_TYPE'][ca]
-    
-    
+
+    # Skip levels that are unfeasible from simple energy bounds
+    arrays = sm.day_arrays(profile, price_col, capacity)
+    level, failed = fs.screen_day(
+        arrays, charger1, charger2, rel_charge.loc[vehicles].values,
+        next_req.loc[vehicles].values,
+        [battery_cap[v] for v in vehicles])
+    build_start = tm.start()
     sessions = profile['Session'].unique()
     # print(sessions)
     #print(sessions)
@@ -980,62 +1661,59 @@ def linear_optimiser_V6(profile, ca, charger1, charger2,
                 profile_av.loc[(period, vehicle), 'Session']]
             * (charger2-charger1)) * gv.TIME_FRACT)
     # Final SOC constraint
+    final = {}
+    main_final_rhs = {}
     for vehicle in vehicles:
         # Get profile for single vehicle
         vehicle_prof = profile_av.loc[(slice(None), vehicle), 'Battery_Use']
-        prob += lpSum([outputs[period, vehicle] * gv.CHARGER_EFF
-                      for period, vehicle in vehicle_prof.index]) == - (
+        main_final_rhs[vehicle] = - (
             profile.loc[(slice(None), vehicle), 'Battery_Use'].sum()
             + rel_charge[vehicle])  # Initial missing charge
+        final[vehicle] = lpSum([outputs[period, vehicle] * gv.CHARGER_EFF
+                                for period, vehicle in vehicle_prof.index]
+                               ) == main_final_rhs[vehicle]
+        prob += final[vehicle]
     # Intermediate SOC constraints
-    for vehicle in vehicles:
-        vehicle_prof = profile_av.loc[(slice(None), vehicle), 'Battery_Use']
-        for period in vehicle_prof.index.get_level_values(0):
-            cumul_use = profile.loc[(slice(period), vehicle),
-                                    'Battery_Use'].sum()
-            cumul_profile = profile_av.loc[(slice(period), vehicle),
-                                           'Battery_Use']
-            prob += lpSum(  # Doesn't go over 100% SOC
-                [outputs[period, vehicle] * gv.CHARGER_EFF
-                    for period, vehicle in cumul_profile.index]
-            ) + cumul_use + rel_charge[vehicle] <= 0.00001
-        # Make sure it doesn't go below 0% SOC at every return
-        profile_ret = profile[profile['Return'] == 1]
-        #print(profile_ret)
-        if vehicle in profile_ret.index.get_level_values('Vehicle_ID'):
-            returns = profile_ret.loc[(slice(None), vehicle),
-                                      'Battery_Use']
-            for period in returns.index.get_level_values(0):
-                cumul_use = profile.loc[(slice(period), vehicle),
-                                        'Battery_Use'].sum()
-                cumul_profile = profile_av.loc[
-                    (slice(period), vehicle), 'Battery_Use']
-                prob += lpSum(  # Doesn't go below 0% SOC
-                    [outputs[period, v] * gv.CHARGER_EFF
-                        for period, v in cumul_profile.index]
-                ) + cumul_use + rel_charge[vehicle] + battery_cap[vehicle] >= 0
+    soc_constraints(prob, outputs, profile, rel_charge, battery_cap)
 
     n = len(time_periods.unique())
+    site = {}
     for idx, period in enumerate(time_periods):
         time_veh = list(profile_av.loc[period].index)
-        prob += lpSum(  # limits the overall site capacity
+        site[period] = lpSum(  # limits the overall site capacity
             [outputs[period, vehicle] for vehicle in time_veh] + battery[idx]) <= (
                 capacity.loc[period] * gv.TIME_FRACT)
+        prob += site[period]
         prob += lpSum(  # limits the number of fast chargers
             [ch_assignment[profile_av.loc[(period, v), 'Session']]
                 for v in time_veh]) <= gv.NUM_FAST_CH
 
-    # Solve and print to the screen
-    prob.solve(PULP_CBC_CMD(msg=False))
+    prob.build_time = tm.stop('build', build_start)
+    prob.level = 'Main'
+    prob.attempts = []
+    if level == 'Main':
+        # Solve and print to the screen
+        with tm.stage('solve'):
+            slv.solve_pulp(prob)
+        record_attempt(prob, 'Main', prob.build_time)
+    else:
+        print(ca, 'Main unfeasible by bounds:', failed)
+        note += ' (' + failed + ')'
+        prob.status = -1
     #print(ca, "status:", LpStatus[prob.status])
-    # If unfeasible, tries to charge to next day
+    # If unfeasible, tries to charge to next day on the same problem
     if prob.status == -1:
         print("=========================================")
         # df = magic_charging(profile, ca, rel_charge)
-        df, note2, opt_level = charge_tonextday(
-            profile, ca, charger1, charger2, capacity,
-            rel_charge, next_req, battery_cap)
-        note += '\nMain unfeasible'
+        parts = SimpleNamespace(
+            outputs=outputs, ch_assignment=ch_assignment, final=final,
+            main_final_rhs=main_final_rhs, site=site, capacity=capacity,
+            profile_av=profile_av, price_col=price_col)
+        df, dfb, note2, opt_level = pulp_cascade(
+            prob, parts, profile, ca, rel_charge, next_req, battery_cap,
+            start_level='Tonext' if level == 'Main' else level)
+        prob.status = -1  # Status of Main
+        note = '\nMain unfeasible' + note
         note += note2
     else:
         # Get output variables
@@ -1080,3 +1758,244 @@ def linear_optimiser_V6(profile, ca, charger1, charger2,
         df.groupby('Vehicle_ID').sum()[output_col]*gv.CHARGER_EFF
         + profile.groupby('Vehicle_ID').sum()['Battery_Use'])).round(6)
     return df, prob, final_soc, note, opt_level, dfb
+
+
+def build_day_V8(profile, ca, charger1, charger2, capacity, battery_cap,
+                 soc_form=None):
+    """Builds the linear_optimiser_V8 model of a day with full SOC
+
+    Args:
+        profile (DataFrame or DenseDay): empty profile of a single day
+        ca (str): category to use in optimisation (opt, BAU)
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        capacity (Series): max allowed site capacity per time period
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        soc_form (str): 'cumulative' or 'state', gv.SOC_FORM if None
+
+    Returns:
+        dict: arrays from sparse_model.day_arrays
+        SparseModel: model, set_rel_charge still to be applied
+    """
+    start = time.perf_counter()
+    arrays = sm.day_arrays(profile, gv.CAT_COLS['PRICE'][ca], capacity)
+    model = sm.build_day_model(
+        arrays, charger1, charger2,
+        [battery_cap[v] for v in arrays['vehicles']], soc_form)
+    model.build_time = time.perf_counter() - start
+    return arrays, model
+
+
+def linear_optimiser_V8(profile, ca, charger1, charger2,
+                        capacity, rel_charge, next_req, battery_cap,
+                        built=None):
+    """Linear optimisation for a single day, built in matrix form
+
+    Same model as linear_optimiser_V6, but the objective, bounds and
+    constraint rows are generated from NumPy arrays of availability,
+    battery use and sessions (see sparse_model.py) and the whole model
+    is passed to HiGHS in a single call. Outputs of periods when a
+    vehicle is away are fixed to 0. If unfeasible, the same model goes
+    through the fallback levels of charge_cascade.
+
+    Args:
+        profile (DataFrame or DenseDay): empty profile of a single day
+        ca (str): category to use in optimisation (opt, BAU)
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        capacity (Series): max allowed site capacity per time period
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        next_req (Series): battery requirements for next day per vehicle
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        built (tuple): (arrays, model) from build_day_V8, built here
+            if None
+
+    Returns:
+        DataFrame: Outputs for each time period
+        SparseModel: arrays, status and solution of the model
+        Series: end of day final SOC for each vehicle
+        str: a note on outcomes of the daily optimisation
+        opt_level (str): the level of optimisation that was feasible
+        DataFrame: site battery outputs for each time period
+    """
+    output_col = gv.CAT_COLS['OUTPUT'][ca]
+    ch_col = gv.CAT_COLS['CH_TYPE'][ca]
+    if built is None:
+        built = build_day_V8(profile, ca, charger1, charger2, capacity,
+                             battery_cap)
+    arrays, model = built
+    vehicles = arrays['vehicles']
+    sm.set_rel_charge(model, rel_charge.loc[vehicles].values)
+    note = ''
+    # Skip levels that are unfeasible from simple energy bounds
+    level, failed = fs.screen_day(
+        arrays, charger1, charger2, model.rel_charge,
+        next_req.loc[vehicles].values,
+        [battery_cap[v] for v in vehicles])
+    if level == 'Main':
+        sm.solve_model(model)
+        # Built for an earlier attempt (the heuristic's LP) or here
+        record_attempt(model, 'Main',
+                       0. if model.attempts else model.build_time)
+    else:
+        print(ca, 'Main unfeasible by bounds:', failed)
+        note += ' (' + failed + ')'
+        model.status = -1
+    # Battery outputs are zero unless Main is feasible
+    df, dfb = sm.model_outputs(model, arrays, output_col, ch_col)
+    if model.status == -1:
+        print("=========================================")
+        df, dfb, note2, opt_level = charge_cascade(
+            profile, ca, charger1, charger2, capacity,
+            rel_charge, next_req, battery_cap, built,
+            start_level='Tonext' if level == 'Main' else level)
+        model.status = -1  # Status of Main, as with V6
+        note = '\nMain unfeasible' + note
+        note += note2
+    else:
+        opt_level = 'Main'
+
+    # Generate a final SoC array
+    final_soc = (rel_charge + (
+        df.groupby('Vehicle_ID').sum()[output_col]*gv.CHARGER_EFF
+        + pd.Series(arrays['battery_use'].sum(axis=0),
+                    index=vehicles))).round(6)
+    return df, model, final_soc, note, opt_level, dfb
+
+
+def linear_optimiser_window(profile, ca, charger1, charger2,
+                            capacity, rel_charge, next_req, battery_cap,
+                            window):
+    """Rolling horizon optimisation of the first day of a window
+
+    The days of the window are solved as one model, with the SOC carried
+    across each midnight (sparse_model.link_days), so only the last day
+    has to end full. Only the first day's outputs are kept, the next
+    window starts from its final SOC. If the window is unfeasible, the
+    day goes through linear_optimiser_V8 and its fallback levels alone.
+
+    Args:
+        profile (DataFrame or DenseDay): empty profile of the first day
+        ca (str): category to use in optimisation (opt, BAU)
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        capacity (Series): max allowed site capacity per time period
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        next_req (Series): battery requirements for next day per vehicle
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+        window (list): (arrays, model) of each day of the window from
+            build_day_V8 in the 'state' SOC form, first day first
+
+    Returns:
+        DataFrame: Outputs for each time period of the first day
+        SparseModel: model of the window, with the attempts of the
+            day alone if the window is unfeasible
+        Series: end of day final SOC for each vehicle
+        str: a note on outcomes of the daily optimisation
+        opt_level (str): the level of optimisation that was feasible
+        DataFrame: site battery outputs for each time period
+    """
+    output_col = gv.CAT_COLS['OUTPUT'][ca]
+    ch_col = gv.CAT_COLS['CH_TYPE'][ca]
+    arrays, day_model = window[0]
+    vehicles = arrays['vehicles']
+    model = sm.link_days([m for _, m in window])
+    sm.set_rel_charge(model, rel_charge.loc[vehicles].values)
+    sm.solve_model(model)
+    record_attempt(model, 'Main', model.build_time)
+    if model.status != 1:
+        print(ca, '{}-day window unfeasible, solving the day alone'.format(
+            len(window)))
+        df, _, final_soc, note, opt_level, dfb = linear_optimiser_V8(
+            profile, ca, charger1, charger2, capacity, rel_charge,
+            next_req, battery_cap, built=window[0])
+        model.attempts += day_model.attempts
+        return (df, model, final_soc, '\nWindow unfeasible' + note,
+                opt_level, dfb)
+    sm.split_days(model)
+    df, dfb = sm.model_outputs(day_model, arrays, output_col, ch_col)
+
+    # Generate a final SoC array
+    final_soc = (rel_charge + (
+        df.groupby('Vehicle_ID').sum()[output_col]*gv.CHARGER_EFF
+        + pd.Series(arrays['battery_use'].sum(axis=0),
+                    index=vehicles))).round(6)
+    return df, model, final_soc, '', 'Main', dfb
+
+
+def linear_optimiser_heuristic(profile, ca, charger1, charger2,
+                               capacity, rel_charge, next_req,
+                               battery_cap):
+    """Greedy charging for a single day, MILP only when it's not good
+
+    Schedules outputs with heuristic.greedy_schedule. If the heuristic
+    can't meet every need the day is solved with linear_optimiser_V8,
+    reusing the model built for it. The cost is also compared with the
+    LP relaxation of the model, and the day goes to V8 if it's more
+    than gv.HEURISTIC_GAP above the bound (no LP if it's None).
+
+    Args:
+        profile (DataFrame or DenseDay): empty profile of a single day
+        ca (str): category to use in optimisation (opt, BAU)
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        capacity (Series): max allowed site capacity per time period
+        rel_charge (Series): list of intial battery charge state
+            relative to full. Index are Vehicle_ID
+        next_req (Series): battery requirements for next day per vehicle
+        battery_cap (dict): dictionary of vehicle ID and their capacity
+
+    Returns:
+        DataFrame: Outputs for each time period
+        SparseModel: heuristic solution, with the LP bound and gap
+            (None without the LP check), or the solved MILP
+        Series: end of day final SOC for each vehicle
+        str: a note on outcomes of the daily optimisation
+        opt_level (str): the level of optimisation that was feasible
+        DataFrame: site battery outputs for each time period
+    """
+    output_col = gv.CAT_COLS['OUTPUT'][ca]
+    ch_col = gv.CAT_COLS['CH_TYPE'][ca]
+    arrays, model = build_day_V8(profile, ca, charger1, charger2,
+                                 capacity, battery_cap)
+    vehicles = arrays['vehicles']
+    sm.set_rel_charge(model, rel_charge.loc[vehicles].values)
+    outputs, fast = hr.greedy_schedule(
+        arrays, charger1, charger2, model.rel_charge,
+        [battery_cap[v] for v in vehicles])
+    if outputs is None:
+        print(ca, 'Heuristic unfeasible, solving MILP')
+        return linear_optimiser_V8(profile, ca, charger1, charger2,
+                                   capacity, rel_charge, next_req,
+                                   battery_cap, built=(arrays, model))
+    cost = arrays['price'] @ outputs.sum(axis=1)
+    bound = None
+    if gv.HEURISTIC_GAP is not None:
+        bound = hr.lp_bound(model)
+        if bound is None or cost - bound > gv.HEURISTIC_GAP * abs(bound):
+            print(ca, 'Heuristic cost', cost, 'bound', bound,
+                  'solving MILP')
+            record_attempt(model, 'LP', model.build_time)
+            return linear_optimiser_V8(profile, ca, charger1, charger2,
+                                       capacity, rel_charge, next_req,
+                                       battery_cap, built=(arrays, model))
+    x = np.zeros(model.num_variables())
+    x[model.cols['output']] = outputs
+    x[model.cols['charger'][arrays['available']]] = fast[
+        arrays['available']]
+    model.x = x
+    model.status = 1
+    model.objective = cost
+    model.bound = bound
+    if bound is not None:
+        model.gap = (cost - bound) / abs(bound) if bound else 0.0
+    df, dfb = sm.model_outputs(model, arrays, output_col, ch_col)
+
+    # Generate a final SoC array
+    final_soc = (rel_charge + (
+        df.groupby('Vehicle_ID').sum()[output_col]*gv.CHARGER_EFF
+        + pd.Series(arrays['battery_use'].sum(axis=0),
+                    index=vehicles))).round(6)
+    return df, model, final_soc, '', 'Main', dfb
@@ -70,7 +70,7 @@ for ch in chargers:
             'BAU': capacity['Available_nolim']
         }
 
-        profile_out, dates, bad_days, lpprob, status, bats = (
+        profile_out, dates, bad_days, lpprob, status, bats, telemetry = (
             lpf.optimise_range3(vehicle_profs,
                                 ch, site_capacity, vDict, batteries))
 
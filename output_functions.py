@@ -12,8 +12,10 @@ import matplotlib.font_manager as font_manager
 import plotly.graph_objects as go
 import plotly.io as pio
 import os
+import timings as tm
 
 
+@tm.timed('summary_outputs')
 def summary_outputs(profile, journeys, cap, status, dictV, bats):
     """Creates summary columns and dataframes from outputs
 
@@ -23,23 +25,78 @@ def summary_outputs(profile, journeys, cap, status, dictV, bats):
         cap (Series): max allowed site capacity per time period
         status (DataFrame): level of optimisation for each day
         dictV (dict): dictionary of vehicle IDs and model
+        bats (list): site battery outputs of each day / category
 
     Returns:
         DataFrames: dfs corresponding to overall profile, site
             site aggregation, day summary and global summary.
     """
 
-    battery = pd.DataFrame()
-    bout = []
-    for b in bats:
-        bout.append(b['Output_Opt'].values)
+    battery_cap = {k: gv.VSPEC[dictV[k]]['C'] for k in dictV.keys()}
+    range_profile, _ = summary_columns(profile, battery_cap)
+    site = site_summary(range_profile, battery_output(bats), cap)
+    day_summary = days_summary(site, status)
+    # day_summary['%BAU'] = 100 * (
+    #     day_summary['ECost_BAU'] - day_summary['ECost_Opt']
+    #     )/day_summary['ECost_BAU']
+    # day_summary['%BAU2'] = 100 * (
+    #     day_summary['ECost_BAU2'] - day_summary['ECost_Opt']
+    #     )/day_summary['ECost_BAU2']
+
+    # Clean to only optimal days
+    # clean_summary = day_summary.copy()
+    # for ca in gv.CATS:
+    #     clean_summary = clean_summary[
+    #         clean_summary[gv.CAT_COLS['OUTPUT'][ca]] != 0]
+    global_summary = day_summary.sum()
+    for ca in gv.CATS:
+        global_summary.drop(labels=gv.CAT_COLS['LEVEL'][ca],
+                            inplace=True)
+    global_summary = global_summary.append(
+        day_summary.groupby(
+            gv.CAT_COLS['LEVEL'][gv.CATS[0]]).count()['Battery_Use'])
+    # c = gv.CATS[0]
+    # global_summary[gv.CAT_COLS['LEVEL'][c]] = day_summary.groupby(
+    #     c).agg({'BAU':'count'}).T
+    # global_summary['%BAU'] = 100 * (
+    #     global_summary['ECost_BAU'] - global_summary['ECost_Opt']
+    #     )/global_summary['ECost_BAU']
+    # global_summary['%BAU2'] = 100 * (
+    #     global_summary['ECost_BAU2'] - global_summary['ECost_Opt']
+    #     )/global_summary['ECost_BAU2']
+    return range_profile, site, day_summary, global_summary
+
+
+def summary_columns(profile, battery_cap, rel_charge=None):
+    """Adds charge delivered, energy cost and SOC of each category
+
+    SOC is the cumulative charge delivered and battery use of each
+    vehicle, summed for all vehicles at once on a (period, vehicle)
+    table.
+
+    Args:
+        profile (DataFrame): output per time period, per vehicle
+        battery_cap (dict): battery capacity per vehicle
+        rel_charge (dict): charge relative to full per vehicle before
+            the first period, per category (full if None)
 
-    battery['Output_Opt'] = bout
-    print(battery)
+    Returns:
+        DataFrame: profile with the summary columns
+        dict: charge relative to full per vehicle after the last
+            period, per category
+    """
     cols = gv.CAT_COLS
-    battery_cap = {k: gv.VSPEC[dictV[k]]['C'] for k in dictV.keys()}
-    vehicles = profile.index.get_level_values(1).unique()
     range_profile = profile.fillna(0)
+    vehicles = range_profile.index.get_level_values('Vehicle_ID')
+    cap_v = vehicles.map(battery_cap).values
+
+    def cumulative(col):
+        # Cumulative sum per vehicle, on a (period, vehicle) table
+        dense = range_profile[col].unstack('Vehicle_ID')
+        return dense.cumsum().stack().reindex(range_profile.index)
+
+    cumul_use = cumulative('Battery_Use')
+    final = {}
     for ca in gv.CATS:
         range_profile[cols['CHARGE_DEL'][ca]] = (
             range_profile[cols['OUTPUT'][ca]]
@@ -47,18 +104,48 @@ def summary_outputs(profile, journeys, cap, status, dictV, bats):
         range_profile[cols['ECOST'][ca]] = (
             range_profile[cols['OUTPUT'][ca]]
             * range_profile[cols['PRICE']['opt']])
-        for vehicle in vehicles:
-            range_profile.loc[(slice(None), vehicle), cols['SOC'][ca]] = (
-                battery_cap[vehicle]
-                + range_profile.loc[
-                    (slice(None), vehicle), cols['CHARGE_DEL'][ca]].cumsum()
-                + range_profile.loc[
-                    (slice(None), vehicle), 'Battery_Use'].cumsum()
-                )*100/battery_cap[vehicle]
-
-    # Sum all vehicles, per time period
+        soc = cap_v + cumulative(cols['CHARGE_DEL'][ca]) + cumul_use
+        start = pd.Series(0., index=list(battery_cap))
+        if rel_charge is not None:
+            start = rel_charge[ca]
+            soc += vehicles.map(start).values
+        range_profile[cols['SOC'][ca]] = soc*100/cap_v
+        change = range_profile[[cols['CHARGE_DEL'][ca], 'Battery_Use']].sum(
+            axis=1).groupby(level='Vehicle_ID').sum()
+        final[ca] = start.add(change, fill_value=0)
+    return range_profile, final
+
+
+def battery_output(bats):
+    """Total site battery output per time period
+
+    Args:
+        bats (list): site battery outputs of each day / category
+
+    Returns:
+        Series: output per time period, None if there are no batteries
+    """
+    bats = [b for b in bats if len(b) > 0]
+    if not bats:
+        return None
+    return pd.concat(bats).groupby('from')['Output_Opt'].sum()
+
+
+def site_summary(range_profile, battery, cap):
+    """Sums the outputs of all vehicles per time period
+
+    Args:
+        range_profile (DataFrame): profile with the summary columns of
+            summary_outputs
+        battery (Series): site battery output per time period
+        cap (Series): max allowed site capacity per time period
+
+    Returns:
+        DataFrame: site aggregation per time period, with its date
+    """
+    cols = gv.CAT_COLS
     site = range_profile.groupby(level=0).sum()
-    site['Battery'] = battery['Output_Opt']
+    site['Battery'] = battery
     site[cols['PRICE']['opt']] = range_profile[
         cols['PRICE']['opt']].groupby(level=0).mean()
     site.drop(columns=[cols['PRICE']['BAU']], inplace=True)
@@ -70,45 +157,98 @@ def summary_outputs(profile, journeys, cap, status, dictV, bats):
             bool).groupby(level=0).sum()
         site[cols['BREACH'][ca]] = site[cols['OUTPUT'][ca]] > (
             site['Available_kW'] * gv.TIME_FRACT+0.01)
-
-    # Daily summaries
     site['date'] = site.index.date - (
         site.index.time < gv.CHAR_ST).astype(int) * dt.timedelta(days=1)
+    return site
+
+
+def days_summary(site, status):
+    """Sums the site aggregation per day
+
+    Args:
+        site (DataFrame): output of site_summary
+        status (DataFrame): level of optimisation for each day
+
+    Returns:
+        DataFrame: day summary, days without a status are dropped
+    """
+    cols = gv.CAT_COLS
     day_summary = site.groupby('date').sum()
     day_summary.drop(columns=[cols['PRICE']['opt'], 'Available'], inplace=True)
     day_summary = day_summary.merge(status, left_index=True, right_index=True)
     for ca in gv.CATS:
         day_summary.drop(columns=[cols['NUM'][ca], cols['SOC'][ca]],
                          inplace=True)
-    # day_summary['%BAU'] = 100 * (
-    #     day_summary['ECost_BAU'] - day_summary['ECost_Opt']
-    #     )/day_summary['ECost_BAU']
-    # day_summary['%BAU2'] = 100 * (
-    #     day_summary['ECost_BAU2'] - day_summary['ECost_Opt']
-    #     )/day_summary['ECost_BAU2']
+    return day_summary
 
-    # Clean to only optimal days
-    # clean_summary = day_summary.copy()
-    # for ca in gv.CATS:
-    #     clean_summary = clean_summary[
-    #         clean_summary[gv.CAT_COLS['OUTPUT'][ca]] != 0]
-    global_summary = day_summary.sum()
-    for ca in gv.CATS:
-        global_summary.drop(labels=gv.CAT_COLS['LEVEL'][ca],
-                            inplace=True)
-    global_summary = global_summary.append(
-        day_summary.groupby(
-            gv.CAT_COLS['LEVEL'][gv.CATS[0]]).count()['Battery_Use'])
-    # c = gv.CATS[0]
-    # global_summary[gv.CAT_COLS['LEVEL'][c]] = day_summary.groupby(
-    #     c).agg({'BAU':'count'}).T
-    # global_summary['%BAU'] = 100 * (
-    #     global_summary['ECost_BAU'] - global_summary['ECost_Opt']
-    #     )/global_summary['ECost_BAU']
-    # global_summary['%BAU2'] = 100 * (
-    #     global_summary['ECost_BAU2'] - global_summary['ECost_Opt']
-    #     )/global_summary['ECost_BAU2']
-    return range_profile, site, day_summary, global_summary
+
+def stream_outputs(days, cap, dictV, root=None, branch=None):
+    """Summaries of a range optimised with lin_prog_functions.iter_range
+
+    Takes the days one at a time, so only a day's profile is ever in
+    memory. The summary columns of summary_outputs are added to each
+    day, with the SOC carried over from the previous days, and the
+    day's range profile and site aggregation are appended to Parquet
+    datasets in root (see parquet_store.write_outputs). The global
+    summary and the count of days per level are running totals.
+
+    Args:
+        days (iterator): days from lin_prog_functions.iter_range
+        cap (Series): max allowed site capacity per time period
+        dictV (dict): dictionary of vehicle IDs and model
+        root (str): folder of the run, nothing is stored if None
+        branch (int): branch ID
+
+    Returns:
+        DataFrame: day summary
+        Series: global summary, as in summary_outputs
+        String: list of dates when optimisation is unfeasible or there
+                are no journeys
+        DataFrame: solver telemetry for each day / category
+    """
+    if root is not None:
+        import parquet_store as ps  # pyarrow is only needed to store
+    cols = gv.CAT_COLS
+    level_col = cols['LEVEL'][gv.CATS[0]]
+    battery_cap = {k: gv.VSPEC[dictV[k]]['C'] for k in dictV.keys()}
+    rel_charge = None  # Full at the start of the range
+    all_days = []
+    telemetry = []
+    totals = None
+    level_count = pd.Series(dtype=int)
+    bad_days = '\nBad days:\n'
+    for res in days:
+        bad_days += res.bad_days
+        if res.profile is None:
+            continue
+        with tm.stage('summary_outputs'):
+            range_profile, rel_charge = summary_columns(
+                res.profile, battery_cap, rel_charge)
+            site = site_summary(range_profile, battery_output(res.bats),
+                                cap)
+            day_status = pd.DataFrame(
+                res.status, index=[res.day]).rename(
+                    columns=cols['LEVEL'])
+            day_summary = days_summary(site, day_status)
+        if root is not None:
+            ps.write_frame(range_profile, os.path.join(
+                root, 'range_profiles'), branch)
+            ps.write_frame(site, os.path.join(root, 'site_summary'), branch)
+        all_days.append(day_summary)
+        telemetry += res.telemetry
+        day_totals = day_summary.drop(
+            columns=[cols['LEVEL'][ca] for ca in gv.CATS]).sum()
+        totals = day_totals if totals is None else totals + day_totals
+        level_count = level_count.add(
+            day_summary[level_col].value_counts(), fill_value=0)
+    day_summary = pd.concat(all_days).rename_axis(None)
+    telemetry = pd.DataFrame(telemetry).set_index(['date', 'category'])
+    if root is not None:
+        ps.write_frame(day_summary.rename_axis('date'),
+                       os.path.join(root, 'days_summary'), branch)
+        ps.write_frame(telemetry, os.path.join(root, 'telemetry'), branch)
+    global_summary = pd.concat([totals, level_count.astype(int)])
+    return day_summary, global_summary, bad_days, telemetry
 
 
 def summary_plot(site_summary):
@@ -360,29 +500,30 @@ def fig_scenario_count(df, x):
     return fig
 
 
-def createHeatmap(profile, desc="", zrange=[0, 100]):
+def createHeatmap(profile, desc="", zrange=[0, 100], show=True):
     """Generate heatmaps for charging schedules
 
     Args:
-        profile (DataFrame): Profile aggregated at site level
+        profile (DataFrame): Profile aggregated at site level, it isn't
+            modified
         desc (str): description to include in tite
+        zrange (list): min and max of the colour scale
+        show (bool): open the figure in a viewer (off in headless runs)
 
     Returns:
         fig: heatmap
     """
-    profile['day'] = profile.index.date
-    profile['time'] = profile.index.time
+    index = pd.DatetimeIndex(profile.index)
     dates = profile['date'].unique()
-    timeperiods = np.sort(profile['time'].unique())
-
-    loads = np.zeros((len(timeperiods), len(dates)))
+    timeperiods = np.unique(index.time)
 
-    for i, date in enumerate(dates):
-        for j, tp in enumerate(timeperiods):
-            fulldt = dt.datetime.combine(date, tp)
-            if fulldt in profile.index:
-                loads[j, i] = 2*profile.loc[
-                    fulldt, gv.CAT_COLS['OUTPUT'][gv.CATS[0]]]
+    # Periods as rows, calendar days as columns, 0 where there's no data
+    loads = pd.Series(
+        2*profile[gv.CAT_COLS['OUTPUT'][gv.CATS[0]]].values,
+        index=[index.time, index.date]).unstack()
+    loads = loads.reindex(
+        index=timeperiods, columns=pd.to_datetime(dates).date).fillna(
+            0).values
 
     # use loads, dates, and timeperiods as your data
     fig = go.Figure(data=go.Heatmap(
@@ -398,7 +539,8 @@ def createHeatmap(profile, desc="", zrange=[0, 100]):
         title="EV Charging schedule from"+str(dates[0])+" to "+str(dates[-1])
         + '\n' + str(desc)
     )
-    fig.show()
+    if show:
+        fig.show()
     return fig
 
 
@@ -424,12 +566,15 @@ def create_grid_file(path):
 
 
 def write_grid_file(path, run, branch, charger, cap,
-                    runtime, global_summary, notes, veh, numV):
+                    runtime, global_summary, notes, veh, numV, nfast=None):
     """Write settings and results to the grid file
 
     Args:
         path (str): relative file path for grid file
+        nfast (int): number of fast chargers, gv.NUM_FAST_CH if None
     """
+    if nfast is None:
+        nfast = gv.NUM_FAST_CH
     grid_file = open(path, 'a')
     grid_file.write('\n' + str(run) + ',' + str(branch) + ','
                     + str(charger[0]) + ',' + str(charger[-1]) + ','
@@ -454,7 +599,7 @@ def write_grid_file(path, run, branch, charger, cap,
     grid_file.write(notes + ',' + ca + ',')
     grid_file.write(str(veh[0]) + ',' + str(veh[-1]) + ',')
     grid_file.write(str(numV[0]) + ',' + str(numV[-1]) + ',')
-    grid_file.write(str(gv.NUM_FAST_CH) + ',')
+    grid_file.write(str(nfast) + ',')
     grid_file.close()
     return
 
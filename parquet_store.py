@@ -0,0 +1,213 @@
+# Columnar storage of journeys, profiles and run outputs
+# Frames are stored as Parquet datasets partitioned by branch and date
+# (root/branch=457/date=2021-03-01/part-0.parquet), so a date range or a
+# few columns can be read without loading the whole object.
+
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('branch', pa.int64()), ('date', pa.date32())]),
+    flavor='hive')
+META_KEY = b'smart_charger'
+
+
+def write_frame(df, root, branch, date_col=None, name='part'):
+    """Writes a frame to a dataset, replacing its branch/date partitions
+
+    Only the partitions present in df are replaced, so days can be
+    added to a dataset one at a time.
+
+    Args:
+        df (DataFrame): frame to store, index is restored on reading
+        root (str): dataset folder
+        branch (int): branch ID
+        date_col (str): column or index level to take the dates from
+            if there's no 'date' column or index level
+        name (str): prefix of the file names
+    """
+    names = list(df.index.names)
+    index = []
+    if not isinstance(df.index, pd.RangeIndex):
+        index = [n if n is not None else '__index_level_{}__'.format(i)
+                 for i, n in enumerate(names)]
+    frame = df.rename_axis(index).reset_index() if index else df.copy()
+    if 'date' not in frame:
+        date_type = None  # Partition column only, dropped on reading
+        frame['date'] = frame[date_col]
+    elif pd.api.types.is_datetime64_any_dtype(frame['date']):
+        date_type = 'datetime'
+    else:
+        date_type = 'date'
+    columns = [c for c in frame.columns if c not in index]
+    frame['date'] = pd.to_datetime(frame['date']).dt.date
+    frame['branch'] = branch
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    meta = {'index': index, 'index_names': names, 'columns': columns,
+            'date_type': date_type}
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        META_KEY: json.dumps(meta).encode()})
+    ds.write_dataset(
+        table, root, format='parquet', partitioning=PARTITIONING,
+        basename_template=name + '-{i}.parquet',
+        existing_data_behavior='delete_matching')
+
+
+def date_filter(branch=None, start=None, end=None, filters=None):
+    """Builds the filter expression pushed down to the dataset
+
+    Args:
+        branch (int): branch ID, all branches if None
+        start (date): first date (included)
+        end (date): last date (included)
+        filters (Expression): any other pyarrow.dataset expression
+
+    Returns:
+        Expression: combined filter, None if there's nothing to filter
+    """
+    expr = filters
+    conditions = []
+    if branch is not None:
+        conditions.append(ds.field('branch') == branch)
+    if start is not None:
+        conditions.append(ds.field('date') >= pa.scalar(
+            pd.Timestamp(start).date(), pa.date32()))
+    if end is not None:
+        conditions.append(ds.field('date') <= pa.scalar(
+            pd.Timestamp(end).date(), pa.date32()))
+    for cond in conditions:
+        expr = cond if expr is None else expr & cond
+    return expr
+
+
+def read_frame(root, columns=None, branch=None, start=None, end=None,
+               filters=None):
+    """Reads part of a dataset written with write_frame
+
+    Only the requested columns are read, and partitions / row groups
+    outside the filters are skipped.
+
+    Args:
+        root (str): dataset folder
+        columns (list): columns to read (the index is always read)
+        branch (int): branch ID, all branches if None
+        start (date): first date (included)
+        end (date): last date (included)
+        filters (Expression): any other pyarrow.dataset expression,
+            e.g. ds.field('Vehicle_ID') == 3
+
+    Returns:
+        DataFrame: with the index it was written with, sorted
+    """
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    meta = json.loads(dataset.schema.metadata[META_KEY])
+    index = meta['index']
+    if columns is not None:
+        columns = list(dict.fromkeys(index + list(columns)))
+    table = dataset.to_table(
+        columns=columns, filter=date_filter(branch, start, end, filters))
+    df = table.to_pandas()
+    if 'date' in df and meta['date_type'] == 'datetime':
+        df['date'] = pd.to_datetime(df['date'])
+    if meta['date_type'] is None and (columns is None
+                                      or 'date' not in columns):
+        df.drop(columns='date', errors='ignore', inplace=True)
+    if columns is None or 'branch' not in columns:
+        df.drop(columns='branch', errors='ignore', inplace=True)
+    if index:
+        df.set_index(index, inplace=True)
+        df.rename_axis(meta['index_names'], inplace=True)
+        df.sort_index(inplace=True)
+    # Partition columns come last, back to the order they were written
+    order = [c for c in meta['columns'] if c in df]
+    return df[order + [c for c in df if c not in order]]
+
+
+def dataset_dates(root, branch=None):
+    """Dates stored in a dataset, from the partition folders only
+
+    Args:
+        root (str): dataset folder
+        branch (int): branch ID, all branches if None
+
+    Returns:
+        list: sorted dates
+    """
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    dates = set()
+    for fragment in dataset.get_fragments(
+            filter=date_filter(branch=branch)):
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        dates.add(keys['date'])
+    return sorted(dates)
+
+
+def iter_days(root, columns=None, branch=None, start=None, end=None):
+    """Reads a dataset one date partition at a time
+
+    Args:
+        root (str): dataset folder
+        columns (list): columns to read (the index is always read)
+        branch (int): branch ID, all branches if None
+        start (date): first date (included)
+        end (date): last date (included)
+
+    Yields:
+        date, DataFrame: each stored date in the range and its rows
+    """
+    for date in dataset_dates(root, branch):
+        if ((start is not None and date < pd.Timestamp(start).date())
+                or (end is not None and date > pd.Timestamp(end).date())):
+            continue
+        yield date, read_frame(root, columns, branch, date, date)
+
+
+def write_profile(profile, root, branch):
+    """Stores an empty (or output) profile, one partition per day
+
+    Days start at gv.CHAR_ST, as in the profile's 'date' column.
+
+    Args:
+        profile (DataFrame): MultiIndex profile of each vehicle / time
+            period
+        root (str): dataset folder
+        branch (int): branch ID
+    """
+    write_frame(profile, root, branch, name='profile')
+
+
+def read_profile(root, branch, start=None, end=None, columns=None):
+    """Reads the empty profile of a date range for optimise_range3
+
+    Args:
+        root (str): dataset folder
+        branch (int): branch ID
+        start (date): first day (included)
+        end (date): last day (included)
+        columns (list): columns to read, all if None
+
+    Returns:
+        DataFrame: MultiIndex profile of each vehicle / time period
+    """
+    return read_frame(root, columns, branch, start, end)
+
+
+def write_outputs(root, branch, range_profile, site_profile, days_summary):
+    """Stores the frames from output_functions.summary_outputs
+
+    Args:
+        root (str): folder of the run, one dataset per frame
+        branch (int): branch ID
+        range_profile (DataFrame): outputs per vehicle / time period
+        site_profile (DataFrame): site aggregation per time period
+        days_summary (DataFrame): daily summary, its index is stored
+            as 'date'
+    """
+    write_frame(range_profile, os.path.join(root, 'range_profiles'), branch)
+    write_frame(site_profile, os.path.join(root, 'site_summary'), branch)
+    write_frame(days_summary.rename_axis('date'),
+                os.path.join(root, 'days_summary'), branch)
@@ -0,0 +1,115 @@
+# On-disk cache of preprocessed journeys and empty profiles
+# Profiles only depend on journeys, pricing and timing assumptions, so
+# runs that only change chargers can reuse them.
+
+import hashlib
+import os
+import pickle
+import pandas as pd
+import global_variables as gv
+import testdata_proc as pf
+
+CACHE_VERSION = 2  # Bump when the cached objects or the key change
+
+
+def cache_key(jpath, price, vs, vNum, dates):
+    """Hash of everything prep_data_mixed/create_empty_schedule depend on
+
+    Args:
+        jpath (str): filepath of journey data
+        price (DataFrame): price table
+        vs (list): list of vehicles in use
+        vNum (list): list of (int) number of vehicles of each kind
+        dates (list): list of dates (datetime) in use
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    with open(jpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(pd.util.hash_pandas_object(price, index=True).values.tobytes())
+    settings = [CACHE_VERSION, gv.CHAR_ST, gv.TIME_INT, gv.IS_LEEWAY,
+                gv.REF_CONS, list(vs), list(vNum), [str(d) for d in dates],
+                {v: sorted(gv.VSPEC[v].items()) for v in vs}]
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+
+def cached_profiles(jpath, vs, ch, dates, vNum, price,
+                    cache_dir=None, max_mb=None):
+    """Journeys and empty profiles, from the cache when possible
+
+    On a miss it runs prep_data_mixed and create_empty_schedule and
+    stores the results, then evicts least recently used entries until
+    the cache is under max_mb.
+
+    Args:
+        jpath (str): filepath of journey data
+        vs (list): list of vehicles in use
+        ch (list): list of chargers in use
+        dates (list): list of dates (datetime) in use
+        vNum (list): list of (int) number of vehicles of each kind
+        price (DataFrame): price table
+        cache_dir (str): cache folder, gv.PROFILE_CACHE if None
+        max_mb (float): cache size limit, gv.PROFILE_CACHE_MB if None
+
+    Returns:
+        DataFrame: table of all journeys
+        dict: Vehicle_ID: Vehicle Model
+        DataFrame: empty profile of each vehicle / time period
+    """
+    cache_dir = cache_dir or gv.PROFILE_CACHE
+    max_mb = gv.PROFILE_CACHE_MB if max_mb is None else max_mb
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(jpath, price, vs, vNum, dates)
+    path = os.path.join(cache_dir, key + '.pkl')
+    try:
+        os.utime(path)  # Mark as recently used
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+        print('Profile cache hit:', key[:12], jpath)
+        return cached
+    except FileNotFoundError:
+        pass  # Not cached, or evicted by another worker
+
+    print('Profile cache miss:', key[:12], jpath)
+    journeys, vDict = pf.prep_data_mixed(jpath, vs, ch, dates, vNum)
+    empty_profs = pf.create_empty_schedule(journeys, price)
+    tmp_path = path + '.tmp{}'.format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((journeys, vDict, empty_profs), f)
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_mb, keep=os.path.basename(path))
+    return journeys, vDict, empty_profs
+
+
+def evict(cache_dir, max_mb, keep=None):
+    """Deletes least recently used entries until under max_mb
+
+    Args:
+        cache_dir (str): cache folder
+        max_mb (float): cache size limit
+        keep (str): file name never to delete (the entry just written)
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl') and name != keep:
+            try:
+                st = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue  # Evicted by another worker
+            entries.append((st.st_mtime, st.st_size, name))
+    total = sum(e[1] for e in entries)
+    if keep is not None:
+        total += os.path.getsize(os.path.join(cache_dir, keep))
+    for mtime, size, name in sorted(entries):
+        if total <= max_mb * 1e6:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+            print('Profile cache evicted:', name[:12])
+        except FileNotFoundError:
+            pass  # Evicted by another worker
+        total -= size
@@ -0,0 +1,128 @@
+# Deferred rendering of run figures
+# Figures are drawn from the summaries saved in each run folder, in their
+# own processes, so the optimisation of the next scenarios never waits
+# for matplotlib, kaleido or the HTML export.
+
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib.pyplot as plt
+import global_variables as gv
+import output_functions as of
+import timings as tm
+
+FIGURES = ['range', 'heatmap_png', 'heatmap_html']
+
+
+def load_summaries(run_dir, branch):
+    """Reads the site and day summaries saved by run_scenario
+
+    Args:
+        run_dir (str): folder of the run
+        branch (int): branch ID
+
+    Returns:
+        DataFrame: site aggregation per time period
+        DataFrame: daily summary
+    """
+    if gv.OUTPUT_FORMAT == 'parquet':
+        import parquet_store as ps  # pyarrow is only needed for parquet
+        site_profile = ps.read_frame(
+            os.path.join(run_dir, 'site_summary'), branch=branch)
+        days_summary = ps.read_frame(
+            os.path.join(run_dir, 'days_summary'),
+            branch=branch).rename_axis(None)
+    else:
+        with open(os.path.join(run_dir, 'site_summary'), 'rb') as f:
+            site_profile = pickle.load(f)
+        with open(os.path.join(run_dir, 'days_summary'), 'rb') as f:
+            days_summary = pickle.load(f)
+    return site_profile, days_summary
+
+
+@tm.timed('render')
+def render_run(run_dir, run, branch, figures=None, headless=True,
+               site_profile=None, days_summary=None):
+    """Draws and saves the figures of a run
+
+    Args:
+        run_dir (str): folder of the run
+        run (int): run number
+        branch (int): branch ID
+        figures (list): figure types to draw, from FIGURES (all if None)
+        headless (bool): never open a viewer or an interactive window
+        site_profile (DataFrame): site summary, read from run_dir if None
+        days_summary (DataFrame): daily summary, read from run_dir if None
+
+    Returns:
+        list: paths of the files written
+    """
+    figures = FIGURES if figures is None else figures
+    if headless:
+        plt.switch_backend('Agg')
+    if site_profile is None or days_summary is None:
+        site_profile, days_summary = load_summaries(run_dir, branch)
+    paths = []
+    if 'range' in figures:
+        range_fig = of.daily_summary_plot(days_summary.fillna(0))
+        paths.append(os.path.join(run_dir, 'fig_range{}.svg'.format(run)))
+        range_fig.savefig(paths[-1], bbox_inches="tight")
+        plt.close(range_fig)
+
+    if 'heatmap_png' in figures or 'heatmap_html' in figures:
+        heatplot = of.createHeatmap(
+            site_profile, str(branch), [0, gv.STORE_SPEC[branch]['zMax']],
+            show=not headless)
+        if 'heatmap_png' in figures:
+            paths.append(os.path.join(
+                run_dir, 'heatplot{}.png'.format(run)))
+            heatplot.write_image(paths[-1], width=1800, height=1000)
+        if 'heatmap_html' in figures:
+            paths.append(os.path.join(
+                run_dir, "heatplot{}.html".format(run)))
+            heatplot.write_html(paths[-1])
+    return paths
+
+
+def render_job(run_dir, run, branch, figures=None, headless=True):
+    """render_run in a pool process, with the stage timings of the job
+
+    Returns:
+        list: paths of the files written
+        dict: stage timings (see timings.snapshot)
+    """
+    tm.reset()
+    paths = render_run(run_dir, run, branch, figures, headless)
+    return paths, tm.snapshot()
+
+
+def render_pool(max_workers=None):
+    """Process pool for render_run, separate from the optimisation pool
+
+    Args:
+        max_workers (int): number of processes, gv.RENDER_WORKERS if None
+
+    Returns:
+        ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=max_workers or gv.RENDER_WORKERS)
+
+
+def render_runs(runs, figures=None, headless=True, max_workers=None):
+    """Draws the figures of finished runs in parallel
+
+    Args:
+        runs (list): (run_dir, run, branch) of each run
+        figures (list): figure types to draw, from FIGURES (all if None)
+        headless (bool): never open a viewer or an interactive window
+        max_workers (int): number of processes, gv.RENDER_WORKERS if None
+
+    Returns:
+        dict: run: paths of the files written
+    """
+    with render_pool(max_workers) as ex:
+        futures = {
+            run: ex.submit(render_run, run_dir, run, branch, figures,
+                           headless)
+            for run_dir, run, branch in runs}
+    return {run: f.result() for run, f in futures.items()}
@@ -0,0 +1,226 @@
+# Runs a grid of smart charging scenarios in parallel
+# Each scenario (branch, chargers, vehicles, batteries, fast chargers) is
+# an independent job run in its own process.
+
+import itertools
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import global_variables as gv
+import lin_prog_functions as lpf
+import output_functions as of
+import profile_cache as pc
+import render
+import timings as tm
+
+
+def expand_grid(branches, chargers, vTypes, vNum, batteries, num_fast_ch,
+                first_run):
+    """Lists every combination of settings as a job
+
+    Vehicle types and numbers go together, as in vTypes[i] / vNum[i].
+
+    Args:
+        branches (list): branch IDs
+        chargers (list): list of lists of charger powers
+        vTypes (list): list of lists of vehicle models
+        vNum (list): list of lists of number of vehicles of each model
+        batteries (list): list of site battery settings
+        num_fast_ch (list): numbers of fast chargers
+        first_run (int): run number of the first job
+
+    Returns:
+        list: dict of settings for each job
+    """
+    jobs = []
+    for run, (branch, ch, (vs, num), bat, n_fast) in enumerate(
+            itertools.product(branches, chargers, zip(vTypes, vNum),
+                              batteries, num_fast_ch), start=first_run):
+        jobs.append({
+            'run': run,
+            'branch': branch,
+            'charger': ch,
+            'vs': vs,
+            'vNum': num,
+            'batteries': bat,
+            'nFast': n_fast,
+        })
+    return jobs
+
+
+def run_scenario(job, alldates, price, capacity, notes, figures=True):
+    """Runs the optimisation and outputs of a single job
+
+    Args:
+        job (dict): settings from expand_grid
+        alldates (DatetimeIndex): dates to optimise
+        price (DataFrame): price table
+        capacity (DataFrame): site capacity of the job's branch
+        notes (str): notes for the settings and grid files
+        figures (bool): draw the figures here, otherwise they're left
+            to render.render_run
+
+    Returns:
+        dict: job settings plus runtime, global summary and stage
+            timings
+    """
+    tm.reset()
+    script_strt = time.process_time()
+    gv.NUM_FAST_CH = job['nFast']
+    run, branch, ch, vs = job['run'], job['branch'], job['charger'], job['vs']
+    run_dir = os.path.join(gv.LOGS, 'run{}'.format(run))
+    os.makedirs(os.path.join(run_dir, 'daily'))
+    t = "{}{}{}".format(branch, vs, ch)
+    jpath = os.path.join(gv.JOURNEYS,
+                         "20-12.WEVC.Multi_Optimisation{}.pkl".format(t))
+    print(t, sum(job['vNum']), 'vehicles')
+    journeys, vDict, empty_profs = pc.cached_profiles(
+        jpath, vs, ch, alldates, job['vNum'], price)
+    if gv.OUTPUT_FORMAT == 'parquet':
+        import parquet_store as ps  # pyarrow is only needed for parquet
+        ps.write_frame(journeys, os.path.join(run_dir, 'journeys'), branch)
+        ps.write_profile(empty_profs, os.path.join(
+            run_dir, 'empty_profs{}'.format(t)), branch)
+    else:
+        pickle.dump(journeys,
+                    open(os.path.join(run_dir, 'journeys.pkl'), 'wb'))
+        pickle.dump(empty_profs, open(
+            os.path.join(run_dir, 'empty_profs{}.pkl'.format(t)), 'wb'))
+    print('Profiles done for {}'.format(branch))
+    site_capacity = {
+        'opt': capacity['Available_kW'],
+        'BAU': capacity['Available_nolim']
+    }
+    stream = gv.STREAM_RANGE and gv.OUTPUT_FORMAT == 'parquet'
+    if stream:
+        # Outputs are stored as each day is solved, the site summary
+        # is read back for the figures
+        days_summary, global_summary, bad_days, telemetry = (
+            of.stream_outputs(
+                lpf.iter_range(empty_profs, ch, site_capacity, vDict,
+                               [job['batteries']]),
+                capacity['Available_kW'], vDict, run_dir, branch))
+        site_profile = ps.read_frame(
+            os.path.join(run_dir, 'site_summary'), branch=branch)
+    else:
+        profile_out, dates, bad_days, lpprob, status, bats, telemetry = (
+            lpf.optimise_range3(empty_profs,
+                                ch, site_capacity, vDict,
+                                [job['batteries']]))
+
+        # OUTPUTS
+        range_profile, site_profile, days_summary, global_summary = (
+            of.summary_outputs(profile_out, journeys,
+                               capacity['Available_kW'], status, vDict,
+                               bats))
+    # Figures
+    if figures:
+        render.render_run(run_dir, run, branch, gv.FIGURES, gv.HEADLESS,
+                          site_profile, days_summary)
+
+    # Create a file with notes, settings and results
+    of.create_settings_file(run, run_dir, notes, ch, 10000,
+                            branch, global_summary, bad_days, vDict)
+    # Save dataframes, already stored day by day when streaming
+    if gv.OUTPUT_FORMAT == 'parquet':
+        if not stream:
+            ps.write_outputs(run_dir, branch, range_profile, site_profile,
+                             days_summary)
+            ps.write_frame(telemetry, os.path.join(run_dir, 'telemetry'),
+                           branch)
+    else:
+        pickle.dump(range_profile,
+                    open(os.path.join(run_dir, 'range_profiles'), 'wb'))
+        pickle.dump(site_profile,
+                    open(os.path.join(run_dir, 'site_summary'), 'wb'))
+        pickle.dump(days_summary,
+                    open(os.path.join(run_dir, 'days_summary'), 'wb'))
+        pickle.dump(telemetry,
+                    open(os.path.join(run_dir, 'telemetry'), 'wb'))
+    runtime = time.process_time() - script_strt
+    print('Branch:', branch, 'Runtime:', runtime)
+    for path, row in lpf.solve_overhead(telemetry).iterrows():
+        print('Branch: {} {} solves: {:.2f}s, {:.2f}s of overhead, '
+              '{:.2f}s on the subprocess path'.format(
+                  branch, path, row['solve_time'], row['overhead_time'],
+                  row['cmd_overhead_time']))
+    return dict(job, runtime=runtime, global_summary=global_summary,
+                run_dir=run_dir, timings=tm.snapshot())
+
+
+def run_grid(jobs, grid_file_path, alldates, price, capacity, notes,
+             max_workers=None):
+    """Runs all jobs in a process pool and logs them to the grid file
+
+    Each result row is written to the grid file as soon as its job
+    finishes, in completion order, with the job's stage timings beside
+    it (see timings.timings_path). With gv.DEFER_RENDER the figures of
+    each finished job are drawn in a separate process pool, so they
+    never hold up the optimisation.
+
+    Args:
+        jobs (list): settings from expand_grid
+        grid_file_path (str): grid file, created with create_grid_file
+        alldates (DatetimeIndex): dates to optimise
+        price (DataFrame): price table
+        capacity (dict): branch: site capacity table
+        notes (str): notes for the settings and grid files
+        max_workers (int): number of processes, one per CPU if None
+
+    Returns:
+        list: results of run_scenario, in completion order, and the job
+            settings with an error (repr of the exception) for each job
+            that failed
+    """
+    if not jobs:
+        return []
+    max_workers = max_workers or os.cpu_count()
+    results = []
+    renders = {}
+    defer = gv.DEFER_RENDER
+    renderer = render.render_pool() if defer else None
+    workers = min(max_workers, len(jobs))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futures = {
+                ex.submit(run_scenario, job, alldates, price,
+                          capacity[job['branch']], notes, not defer): job
+                for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    res = future.result()
+                except Exception as e:
+                    print('Run', job['run'], 'failed:', repr(e))
+                    results.append(dict(job, error=repr(e)))
+                    continue
+                of.write_grid_file(
+                    grid_file_path, res['run'], res['branch'],
+                    res['charger'], gv.STORE_SPEC[res['branch']]['ASC'],
+                    res['runtime'], res['global_summary'], notes,
+                    res['vs'], res['vNum'], nfast=res['nFast'])
+                tm.save(res['timings'],
+                        tm.timings_path(grid_file_path, res['run']))
+                results.append(res)
+                if defer:
+                    renders[res['run']] = renderer.submit(
+                        render.render_job, res['run_dir'], res['run'],
+                        res['branch'], gv.FIGURES, gv.HEADLESS)
+    finally:
+        if defer:
+            # Also on errors, so pending figures don't leak the pool
+            renderer.shutdown()
+    if defer:
+        for res in results:
+            if 'error' in res:
+                continue
+            future = renders[res['run']]
+            if future.exception() is not None:
+                print('Figures of run', res['run'], 'failed:',
+                      repr(future.exception()))
+                continue
+            res['timings'] = tm.merge(res['timings'], future.result()[1])
+            tm.save(res['timings'],
+                    tm.timings_path(grid_file_path, res['run']))
+    return results
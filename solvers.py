@@ -0,0 +1,441 @@
+# Solver backends for the daily charging problems
+# CBC, HiGHS or GLPK, chosen once per run in global_variables with a time
+# limit, a relative MIP gap and a number of threads, for PuLP problems,
+# CVXPY problems and sparse models alike. Statuses are always PuLP codes:
+# 1 optimal (or feasible at the limit), 0 not solved, -1 infeasible,
+# -2 unbounded, -3 undefined.
+# HiGHS runs in this process through highspy. CBC and GLPK run as a
+# subprocess that reads the model from a temporary file, so every solve
+# records the time spent in the solver itself and the overhead around it.
+
+import contextlib
+import os
+import re
+import tempfile
+import time
+from types import SimpleNamespace
+import numpy as np
+import scipy.sparse as sp
+import pulp
+import global_variables as gv
+
+BACKENDS = ['CBC', 'HiGHS', 'GLPK']
+
+
+def backend(name=None, default='CBC'):
+    """Name of the backend to use
+
+    Args:
+        name (str): backend, gv.SOLVER if None
+        default (str): backend if gv.SOLVER is None too
+
+    Returns:
+        str: one of BACKENDS
+    """
+    name = name or gv.SOLVER or default
+    if name not in BACKENDS:
+        raise ValueError('Unknown solver {}, use one of {}'.format(
+            name, BACKENDS))
+    return name
+
+
+@contextlib.contextmanager
+def limits(time_limit=None, gap=None):
+    """Overrides the run's time limit and MIP gap in a with block
+
+    Args:
+        time_limit (float): seconds per solve, the run's if None
+        gap (float): relative MIP gap, the run's if None
+    """
+    previous = gv.SOLVER_TIME_LIMIT, gv.SOLVER_GAP
+    if time_limit is not None:
+        gv.SOLVER_TIME_LIMIT = time_limit
+    if gap is not None:
+        gv.SOLVER_GAP = gap
+    try:
+        yield
+    finally:
+        gv.SOLVER_TIME_LIMIT, gv.SOLVER_GAP = previous
+
+
+def pulp_solver(name=None, warm_start=False):
+    """PuLP solver object with the run's limits
+
+    Args:
+        name (str): backend, gv.SOLVER (or CBC) if None
+        warm_start (bool): pass the current values of the variables as
+            a MIP start (CBC only)
+
+    Returns:
+        LpSolver: solver to pass to LpProblem.solve
+    """
+    name = backend(name)
+    time_limit, gap = gv.SOLVER_TIME_LIMIT, gv.SOLVER_GAP
+    if name == 'CBC':
+        return pulp.PULP_CBC_CMD(msg=False, timeLimit=time_limit,
+                                 gapRel=gap, threads=gv.SOLVER_THREADS,
+                                 warmStart=warm_start)
+    if name == 'HiGHS':
+        return pulp.HiGHS(msg=False, timeLimit=time_limit, gapRel=gap,
+                          threads=gv.SOLVER_THREADS)
+    options = [] if gap is None else ['--mipgap', str(gap)]
+    return pulp.GLPK_CMD(msg=False, timeLimit=time_limit, options=options)
+
+
+def solve_pulp(prob, name=None, warm_start=False):
+    """Solves a PuLP problem with the run's backend and limits
+
+    The default backend is CBC. With gv.SOLVER_IN_PROCESS (or the HiGHS
+    backend) the problem is solved by HiGHS from its arrays, in this
+    process, with no model file or solver subprocess. Sets
+    prob.solve_path ('in-process' or 'subprocess'), prob.solutionTime
+    (wall time of the whole call), prob.solver_time (time reported by
+    the solver itself, None if unknown), prob.cmd_overhead_time (see
+    cmd_overhead) and prob.gap, prob.bound and prob.nodes as in
+    solve_arrays.
+
+    Args:
+        prob (LpProblem): problem to solve
+        name (str): backend, gv.SOLVER (or the default above) if None
+        warm_start (bool): start from the current values of the
+            variables (the last solve's), with CBC and HiGHS
+
+    Returns:
+        int: PuLP status code, also stored in prob.status
+    """
+    name = backend(name, 'HiGHS' if gv.SOLVER_IN_PROCESS else 'CBC')
+    start = time.perf_counter()
+    if name == 'HiGHS':
+        _solve_pulp_highs(prob, warm_start)
+        prob.solve_path = 'in-process'
+    else:
+        prob.solver_time = _solve_pulp_cmd(prob, name, warm_start)
+        prob.solve_path = 'subprocess'
+    prob.solutionTime = time.perf_counter() - start
+    prob.cmd_overhead_time = None
+    if prob.solve_path == 'in-process':
+        prob.cmd_overhead_time = cmd_overhead(prob)
+    if prob.sol_status == pulp.LpSolutionIntegerFeasible:
+        # Stopped by the time limit or gap with a solution
+        prob.status = 1
+    return prob.status
+
+
+_in_process_solves = 0  # PuLP solves on the in-process path so far
+
+
+def cmd_overhead(prob):
+    """Overhead the subprocess path would have had on a solved problem
+
+    Every gv.CMD_OVERHEAD_SAMPLE-th in-process solve, the problem is
+    solved again with CBC through its model file and subprocess, and
+    the wall time not spent in CBC itself is returned, so in-process
+    runs can report the overhead they avoid. The in-process solution
+    and status are kept.
+
+    Args:
+        prob (LpProblem): problem just solved in-process
+
+    Returns:
+        float: overhead (s), None if the solve isn't sampled
+    """
+    global _in_process_solves
+    _in_process_solves += 1
+    sample = gv.CMD_OVERHEAD_SAMPLE
+    if not sample or (_in_process_solves - 1) % sample:
+        return None
+    variables = prob.variables()
+    values = [v.varValue for v in variables]
+    kept = (prob.status, prob.sol_status, prob.gap, prob.bound,
+            prob.nodes)
+    start = time.perf_counter()
+    solver_time = _solve_pulp_cmd(prob, 'CBC')
+    wall = time.perf_counter() - start
+    for v, x in zip(variables, values):
+        v.varValue = x
+    prob.status, prob.sol_status, prob.gap, prob.bound, prob.nodes = kept
+    return None if solver_time is None else wall - solver_time
+
+
+def _solve_pulp_cmd(prob, name, warm_start=False):
+    """Solves with a solver subprocess, returns the solver's wall time
+
+    CBC's log is kept in a temporary file to read its own timing, MIP
+    gap, bound and node count.
+    """
+    prob.gap = prob.bound = prob.nodes = None
+    if name != 'CBC':
+        prob.solve(pulp_solver(name))
+        return None
+    solver = pulp_solver(name, warm_start)
+    fd, log_path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        solver.optionsDict['logPath'] = log_path
+        prob.solve(solver)
+        with open(log_path) as f:
+            log = f.read()
+    finally:
+        os.remove(log_path)
+    prob.gap, prob.bound, prob.nodes = _cbc_mip_stats(log)
+    match = re.search(r'Total time.*Wallclock seconds\):\s*([\d.]+)', log)
+    return float(match.group(1)) if match else None
+
+
+def _cbc_mip_stats(log):
+    """Relative MIP gap, bound and nodes of a CBC log, None if it
+    doesn't report them (LPs, unfeasible problems)"""
+    def number(label):
+        match = re.search(label + r':\s*(-?[\d.e+-]+)', log)
+        return float(match.group(1)) if match else None
+    objective = number('Objective value')
+    nodes = number('Enumerated nodes')
+    if objective is None or nodes is None:
+        return None, None, None
+    bound = number('Lower bound')
+    if bound is None:
+        if 'Result - Optimal solution found' not in log:
+            return None, None, int(nodes)
+        bound = objective
+    # As HiGHS: |objective - bound| / |objective|
+    gap = abs(objective - bound) / abs(objective) if objective else 0.
+    return gap, bound, int(nodes)
+
+
+def pulp_to_arrays(prob):
+    """Arrays of a PuLP problem, the reverse of arrays_to_pulp
+
+    Args:
+        prob (LpProblem): problem, minimised or maximised
+
+    Returns:
+        tuple: c, A (csr_matrix), lb, ub, row_lb, row_ub, integrality as
+            taken by solve_arrays, c negated for a maximisation
+        list: LpVariable of each column
+    """
+    variables = prob.variables()
+    col = {v.name: j for j, v in enumerate(variables)}
+    c = np.zeros(len(variables))
+    for v, coef in prob.objective.items():
+        c[col[v.name]] = coef * prob.sense
+    rows, cols, vals = [], [], []
+    row_lb = np.full(len(prob.constraints), -np.inf)
+    row_ub = np.full(len(prob.constraints), np.inf)
+    for i, con in enumerate(prob.constraints.values()):
+        for v, coef in con.items():
+            rows.append(i)
+            cols.append(col[v.name])
+            vals.append(coef)
+        rhs = -con.constant
+        if con.sense != pulp.LpConstraintLE:
+            row_lb[i] = rhs
+        if con.sense != pulp.LpConstraintGE:
+            row_ub[i] = rhs
+    A = sp.csr_matrix((vals, (rows, cols)),
+                      shape=(len(prob.constraints), len(variables)))
+    lb = np.array([-np.inf if v.lowBound is None else v.lowBound
+                   for v in variables], dtype=float)
+    ub = np.array([np.inf if v.upBound is None else v.upBound
+                   for v in variables], dtype=float)
+    integrality = np.array([v.cat == pulp.LpInteger for v in variables],
+                           dtype=int)
+    return (c, A, lb, ub, row_lb, row_ub, integrality), variables
+
+
+def _solve_pulp_highs(prob, warm_start=False):
+    """Solves a PuLP problem with HiGHS in-process, writing the
+    solution back to its variables like LpProblem.solve"""
+    arrays, variables = pulp_to_arrays(prob)
+    x0 = None
+    if warm_start and any(v.varValue is not None for v in variables):
+        # Variables added since the last solve start at their bound
+        lb, ub = arrays[2], arrays[3]
+        x0 = np.clip([v.varValue or 0. for v in variables], lb, ub)
+    res = _solve_highs(*arrays, x0=x0)
+    for j, v in enumerate(variables):
+        v.varValue = None if res.x is None else res.x[j]
+    prob.status = res.status
+    if res.x is None:
+        prob.sol_status = pulp.LpSolutionNoSolutionFound
+    elif res.optimal:
+        prob.sol_status = pulp.LpSolutionOptimal
+    else:
+        prob.sol_status = pulp.LpSolutionIntegerFeasible
+    prob.solver_time = res.solver_time
+    prob.gap, prob.bound, prob.nodes = res.gap, res.bound, res.nodes
+    return prob.status
+
+
+def solve_cvxpy(problem, name=None):
+    """Solves a CVXPY problem with the run's backend and limits
+
+    Args:
+        problem (cvxpy.Problem): problem to solve
+        name (str): backend, gv.SOLVER (or CBC) if None
+
+    Returns:
+        int: PuLP status code
+    """
+    import cvxpy as cp
+    name = backend(name)
+    time_limit, gap = gv.SOLVER_TIME_LIMIT, gv.SOLVER_GAP
+    threads = gv.SOLVER_THREADS
+    if name == 'CBC':
+        options = {'maximumSeconds': time_limit,
+                   'allowableFractionGap': gap, 'numberThreads': threads}
+        solver = cp.CBC
+    elif name == 'HiGHS':
+        options = {'time_limit': time_limit, 'mip_rel_gap': gap,
+                   'threads': threads}
+        solver = cp.HIGHS
+    else:
+        options = {}  # No limits through CVXOPT's GLPK
+        solver = cp.GLPK_MI
+    problem.solve(solver=solver, **{k: v for k, v in options.items()
+                                    if v is not None})
+    if problem.status in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+        return 1
+    if problem.status in (cp.INFEASIBLE, cp.INFEASIBLE_INACCURATE):
+        return -1
+    if problem.status in (cp.UNBOUNDED, cp.UNBOUNDED_INACCURATE):
+        return -2
+    return 1 if problem.value is not None else 0
+
+
+def solve_arrays(c, A, lb, ub, row_lb, row_ub, integrality, name=None,
+                 x0=None):
+    """Solves min c.x, row_lb <= A.x <= row_ub, lb <= x <= ub
+
+    Args:
+        c (array): objective coefficients
+        A (sparse matrix): constraint matrix
+        lb, ub (array): variable bounds
+        row_lb, row_ub (array): constraint bounds
+        integrality (array): 1 for integer variables
+        name (str): backend, gv.SOLVER (or HiGHS) if None
+        x0 (array): starting solution (warm start), None for none
+
+    Returns:
+        SimpleNamespace: status (PuLP code), x, objective, gap (relative
+            MIP gap), bound (best lower bound on the objective), nodes
+            (branch and bound), solver_time (time reported by the
+            solver, s), None where unknown, and solve_path ('in-process'
+            or 'subprocess')
+    """
+    name = backend(name, default='HiGHS')
+    if name == 'HiGHS':
+        return _solve_highs(c, A, lb, ub, row_lb, row_ub, integrality, x0)
+    prob, x = arrays_to_pulp(c, A, lb, ub, row_lb, row_ub, integrality)
+    if x0 is not None:
+        for v, value in zip(x, x0):
+            v.varValue = value
+    status = solve_pulp(prob, name, warm_start=x0 is not None)
+    if status != 1:
+        return SimpleNamespace(status=status, x=None, objective=None,
+                               gap=None, bound=None, nodes=None,
+                               solver_time=prob.solver_time,
+                               solve_path=prob.solve_path)
+    return SimpleNamespace(status=status,
+                           x=np.array([v.varValue or 0. for v in x]),
+                           objective=pulp.value(prob.objective),
+                           gap=prob.gap, bound=prob.bound,
+                           nodes=prob.nodes,
+                           solver_time=prob.solver_time,
+                           solve_path=prob.solve_path)
+
+
+def arrays_to_pulp(c, A, lb, ub, row_lb, row_ub, integrality):
+    """PuLP problem of a model stored as arrays
+
+    Returns:
+        LpProblem: problem, rows with both bounds finite and different
+            are split in two constraints
+        list: LpVariable of each column
+    """
+    prob = pulp.LpProblem('arrays', pulp.LpMinimize)
+    x = [pulp.LpVariable(
+        'x{}'.format(j),
+        lowBound=None if np.isinf(lb[j]) else lb[j],
+        upBound=None if np.isinf(ub[j]) else ub[j],
+        cat='Integer' if integrality[j] else 'Continuous')
+        for j in range(len(c))]
+    prob += pulp.LpAffineExpression(
+        [(x[j], c[j]) for j in np.flatnonzero(c)])
+    A = sp.csr_matrix(A)
+    for i in range(A.shape[0]):
+        cols = A.indices[A.indptr[i]:A.indptr[i + 1]]
+        vals = A.data[A.indptr[i]:A.indptr[i + 1]]
+        expr = pulp.LpAffineExpression(
+            [(x[j], v) for j, v in zip(cols, vals)])
+        if row_lb[i] == row_ub[i]:
+            prob += expr == row_lb[i]
+            continue
+        if not np.isinf(row_lb[i]):
+            prob += expr >= row_lb[i]
+        if not np.isinf(row_ub[i]):
+            prob += expr <= row_ub[i]
+    return prob, x
+
+
+def _solve_highs(c, A, lb, ub, row_lb, row_ub, integrality, x0=None):
+    """solve_arrays with HiGHS in-process (highspy), x0 is a starting
+    solution (HiGHS repairs it if it's unfeasible)"""
+    import highspy
+    h = highspy.Highs()
+    h.setOptionValue('output_flag', False)
+    if gv.SOLVER_TIME_LIMIT is not None:
+        h.setOptionValue('time_limit', float(gv.SOLVER_TIME_LIMIT))
+    if gv.SOLVER_GAP is not None:
+        h.setOptionValue('mip_rel_gap', float(gv.SOLVER_GAP))
+    if gv.SOLVER_THREADS is not None:
+        h.setOptionValue('threads', int(gv.SOLVER_THREADS))
+    A = sp.csc_matrix(A)
+    lp = highspy.HighsLp()
+    lp.num_col_ = len(c)
+    lp.num_row_ = A.shape[0]
+    lp.col_cost_ = np.asarray(c, dtype=float)
+    lp.col_lower_ = np.asarray(lb, dtype=float)
+    lp.col_upper_ = np.asarray(ub, dtype=float)
+    lp.row_lower_ = np.asarray(row_lb, dtype=float)
+    lp.row_upper_ = np.asarray(row_ub, dtype=float)
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+    lp.a_matrix_.start_ = A.indptr
+    lp.a_matrix_.index_ = A.indices
+    lp.a_matrix_.value_ = A.data
+    mip = bool(np.any(integrality))
+    if mip:
+        lp.integrality_ = [highspy.HighsVarType.kInteger if i
+                           else highspy.HighsVarType.kContinuous
+                           for i in integrality]
+    h.passModel(lp)
+    if x0 is not None:
+        sol = highspy.HighsSolution()
+        sol.col_value = list(x0)
+        sol.value_valid = True
+        h.setSolution(sol)
+    h.run()
+    model_status = h.getModelStatus()
+    info = h.getInfo()
+    ms = highspy.HighsModelStatus
+    has_solution = info.primal_solution_status == 2  # Feasible
+    if model_status == ms.kOptimal:
+        status = 1
+    elif model_status in (ms.kInfeasible, ms.kUnboundedOrInfeasible):
+        status = -1
+    elif model_status == ms.kUnbounded:
+        status = -2
+    elif has_solution:
+        status = 1  # Time, node or gap limit with a solution
+    elif model_status in (ms.kTimeLimit, ms.kIterationLimit,
+                          ms.kSolutionLimit, ms.kInterrupt):
+        status = 0
+    else:
+        status = -3
+    x = np.array(h.getSolution().col_value) if has_solution else None
+    return SimpleNamespace(
+        status=status, x=x, optimal=model_status == ms.kOptimal,
+        objective=info.objective_function_value if has_solution else None,
+        gap=info.mip_gap if mip else None,
+        bound=info.mip_dual_bound if mip else None,
+        nodes=info.mip_node_count if mip else None,
+        solver_time=h.getRunTime(), solve_path='in-process')
@@ -0,0 +1,521 @@
+# Sparse matrix form of the daily charging MILP
+# Builds the same model as linear_optimiser_V6 straight from NumPy arrays
+# and hands it to the run's solver backend (solvers.py) in one call.
+
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import global_variables as gv
+import dense_profile as dp
+import timings as tm
+import solvers as slv
+
+
+class SparseModel:
+    """Daily charging MILP stored as arrays
+
+    Columns are ordered outputs (period-major, one per period/vehicle),
+    charger choice binaries (one per session), site battery outputs
+    (one per period with an available vehicle) and, with the 'state'
+    SOC formulation, SOC per period/vehicle. Row bounds that depend
+    on the initial SOC are kept separately so they can be patched with
+    set_rel_charge without rebuilding the matrix.
+
+    Attributes:
+        c (array): objective coefficients
+        A (csr_matrix): constraint matrix
+        lb, ub (array): variable bounds
+        integrality (array): 1 for binaries, 0 for continuous
+        row_lb, row_ub (array): constraint bounds
+        rows (dict): name: slice of each block of constraints
+        soc_form (str): 'cumulative' or 'state'
+        vehicles (array): Vehicle_ID of each vehicle column, in order
+        level (str): fallback level the model is set to (see set_level)
+        main_final_lb (array): final SOC row bounds of the Main level,
+            kept by set_level while at a fallback level
+        status (int): PuLP status code of the last solve
+        x (array): solution of the last solve
+        build_time (float): wall time to build the model (s)
+        solve_time (float): wall time of all solves of the model (s)
+        solver_time (float): time of all solves reported by the solver
+            itself (s), None if it doesn't report it
+        solve_path (str): 'in-process' or 'subprocess' (see solvers.py)
+        gap (float): relative MIP gap of the last solve
+        bound (float): lower bound on the objective from the last solve
+        nodes (int): branch and bound nodes of the last solve
+        attempts (list): telemetry of each level solved (see
+            lin_prog_functions.record_attempt)
+    """
+
+    def __init__(self, c, A, lb, ub, integrality, row_lb, row_ub,
+                 rel_coef, rel_vehicle, cols, rows):
+        self.c = c
+        self.A = A
+        self.lb = lb
+        self.ub = ub
+        self.integrality = integrality
+        self.base_lb = row_lb
+        self.base_ub = row_ub
+        self.row_lb = row_lb.copy()
+        self.row_ub = row_ub.copy()
+        self.rel_coef = rel_coef
+        self.rel_vehicle = rel_vehicle
+        self.cols = cols
+        self.rows = rows
+        self.soc_form = 'cumulative'
+        self.vehicles = None
+        self.level = 'Main'
+        self.main_final_lb = None
+        self.rel_charge = None
+        self.status = 0
+        self.x = None
+        self.objective = None
+        self.build_time = 0.
+        self.solve_time = 0.
+        self.solver_time = 0.
+        self.solve_path = None
+        self.gap = None
+        self.bound = None
+        self.nodes = None
+        self.attempts = []
+
+    def num_variables(self):
+        return len(self.c)
+
+    def num_constraints(self):
+        return self.A.shape[0]
+
+
+def day_arrays(profile, price_col, capacity):
+    """Extracts the arrays the model is built from
+
+    Args:
+        profile (DataFrame or DenseDay): empty profile of a single day
+        price_col (str): price column to optimise against
+        capacity (Series): max allowed site capacity per time period
+
+    Returns:
+        dict: timeline, vehicles and (period, vehicle) arrays
+    """
+    if isinstance(profile, dp.DenseDay):
+        return profile.arrays(price_col, capacity)
+    frm = profile.index.get_level_values(0).unique()
+    vehicles = profile.index.get_level_values(1).unique()
+    shape = (len(frm), len(vehicles))
+
+    def grid(col):
+        return profile[col].unstack('Vehicle_ID').reindex(
+            index=frm, columns=vehicles).values
+
+    available = grid('Available') == 1
+    return {
+        'from': frm,
+        'vehicles': vehicles,
+        'available': available,
+        'battery_use': grid('Battery_Use').astype(float),
+        'session': grid('Session').astype(np.int64),
+        'return': grid('Return') == 1,
+        'price': profile[price_col].groupby(level=0).first().reindex(
+            frm).values.astype(float),
+        'capacity': capacity.reindex(frm).values.astype(float),
+        'shape': shape,
+    }
+
+
+def _cumulative_rows(avail_idx, counts):
+    """Row/position pairs for rows summing the first n available periods"""
+    mask = np.arange(len(avail_idx)) < np.asarray(counts)[:, None]
+    rows, pos = np.nonzero(mask)
+    return rows, avail_idx[pos]
+
+
+@tm.timed('build')
+def build_day_model(arrays, charger1, charger2, battery_cap,
+                    soc_form=None):
+    """Builds the daily MILP of linear_optimiser_V6 in matrix form
+
+    With the 'cumulative' SOC formulation every plugged in period and
+    every return gets a row summing all earlier outputs (O(T^2)
+    non-zeros per vehicle), as in V6. With 'state' there is one SOC
+    variable per period / vehicle, linked by a one-step balance, and
+    the SOC limits become variable bounds (O(T) non-zeros).
+
+    Args:
+        arrays (dict): output of day_arrays
+        charger1 (int): slow charger power
+        charger2 (int): fast charger power
+        battery_cap (array): battery capacity of each vehicle
+        soc_form (str): 'cumulative' or 'state', gv.SOC_FORM if None
+
+    Returns:
+        SparseModel: model with initial SOC set to full
+    """
+    T, V = arrays['shape']
+    soc_form = soc_form or gv.SOC_FORM
+    av = arrays['available']
+    bu = arrays['battery_use']
+    cap_v = np.asarray(battery_cap, dtype=float)
+    tp = np.flatnonzero(av.any(axis=1))  # periods with a vehicle in
+    sessions, sess_pos = np.unique(arrays['session'], return_inverse=True)
+    sess_pos = sess_pos.reshape(T, V)
+
+    n_out = T * V
+    n_ch = len(sessions)
+    n_bat = len(tp)
+    out_col = np.arange(n_out).reshape(T, V)
+    ch_col = n_out + sess_pos
+    bat_col = n_out + n_ch + np.arange(n_bat)
+    n_soc = n_out if soc_form == 'state' else 0
+    soc_col = n_out + n_ch + n_bat + np.arange(n_soc).reshape(-1, V)
+    n_var = n_out + n_ch + n_bat + n_soc
+
+    c = np.zeros(n_var)
+    c[out_col[av]] = np.broadcast_to(arrays['price'][:, None], (T, V))[av]
+    c[bat_col] = arrays['price'][tp]
+    lb = np.zeros(n_var)
+    ub = np.zeros(n_var)
+    ub[:n_out] = np.where(av, charger2 * gv.TIME_FRACT, 0).ravel()
+    ub[n_out:n_out + n_ch] = 1
+    if n_soc:
+        # Below 100% when plugged in, above 0% on return
+        lb[soc_col] = np.where(arrays['return'], -cap_v, -np.inf)
+        ub[soc_col] = np.where(av, 0.00001, np.inf)
+    integrality = np.zeros(n_var)
+    integrality[n_out:n_out + n_ch] = 1
+
+    # Each block appends (rows, cols, vals) and its row bounds
+    r_idx, c_idx, vals = [], [], []
+    row_lb, row_ub, rel_coef, rel_vehicle = [], [], [], []
+    rows = {}
+    n_rows = 0
+
+    def add_block(name, r, cl, v, lo, hi, coef=0, veh=-1):
+        nonlocal n_rows
+        n = len(lo)
+        r_idx.append(np.asarray(r) + n_rows)
+        c_idx.append(np.asarray(cl))
+        vals.append(np.broadcast_to(v, len(r)).astype(float))
+        row_lb.append(np.asarray(lo, dtype=float))
+        row_ub.append(np.broadcast_to(hi, n).astype(float))
+        rel_coef.append(np.broadcast_to(coef, n).astype(float))
+        rel_vehicle.append(np.broadcast_to(veh, n).astype(np.int64))
+        rows[name] = slice(n_rows, n_rows + n)
+        n_rows += n
+
+    # Charge power: output <= (charger1 + ch * (charger2-charger1)) * TF
+    t_av, v_av = np.nonzero(av)
+    n_av = len(t_av)
+    add_block(
+        'power',
+        np.repeat(np.arange(n_av), 2),
+        np.column_stack([out_col[t_av, v_av], ch_col[t_av, v_av]]).ravel(),
+        np.tile([1, -(charger2 - charger1) * gv.TIME_FRACT], n_av),
+        np.full(n_av, -np.inf), charger1 * gv.TIME_FRACT)
+
+    # Final SOC: back to 100% at the end of the day
+    if n_soc:
+        add_block('final', np.arange(V), soc_col[-1], 1,
+                  np.zeros(V), 0)
+        # SOC balance: soc[t] = soc[t-1] + use[t] + output[t] * eff
+        first = np.arange(T * V) < V
+        row_veh = np.tile(np.arange(V), T)  # Rows are period-major
+        add_block(
+            'balance',
+            np.concatenate([np.arange(T * V), np.arange(V, T * V),
+                            t_av * V + v_av]),
+            np.concatenate([soc_col.ravel(), soc_col[:-1].ravel(),
+                            out_col[t_av, v_av]]),
+            np.concatenate([np.ones(T * V), -np.ones((T - 1) * V),
+                            np.full(n_av, -gv.CHARGER_EFF)]),
+            bu.ravel(), bu.ravel(),
+            coef=first.astype(float),
+            veh=np.where(first, row_veh, -1))
+    else:
+        add_block(
+            'final', v_av, out_col[t_av, v_av], gv.CHARGER_EFF,
+            -bu.sum(axis=0), -bu.sum(axis=0),
+            coef=-1, veh=np.arange(V))
+
+        # Intermediate SOC: below 100% when plugged in, above 0% on return
+        cumul_use = bu.cumsum(axis=0)
+        upper = {'r': [], 'c': [], 'ub': [], 'veh': []}
+        lower = {'r': [], 'c': [], 'lb': [], 'veh': []}
+        n_up = n_lo = 0
+        for v in range(V):
+            avail_idx = np.flatnonzero(av[:, v])
+            r, t = _cumulative_rows(
+                avail_idx, np.arange(1, len(avail_idx) + 1))
+            upper['r'].append(r + n_up)
+            upper['c'].append(out_col[t, v])
+            upper['ub'].append(0.00001 - cumul_use[avail_idx, v])
+            upper['veh'].append(np.full(len(avail_idx), v))
+            n_up += len(avail_idx)
+            returns = np.flatnonzero(arrays['return'][:, v])
+            counts = np.searchsorted(avail_idx, returns, side='right')
+            r, t = _cumulative_rows(avail_idx, counts)
+            lower['r'].append(r + n_lo)
+            lower['c'].append(out_col[t, v])
+            lower['lb'].append(-cumul_use[returns, v] - cap_v[v])
+            lower['veh'].append(np.full(len(returns), v))
+            n_lo += len(returns)
+        upper_ub = np.concatenate(upper['ub'])
+        add_block(
+            'upper', np.concatenate(upper['r']), np.concatenate(upper['c']),
+            gv.CHARGER_EFF, np.full(len(upper_ub), -np.inf), upper_ub,
+            coef=-1, veh=np.concatenate(upper['veh']))
+        lower_lb = np.concatenate(lower['lb'])
+        add_block(
+            'lower', np.concatenate(lower['r']), np.concatenate(lower['c']),
+            gv.CHARGER_EFF, lower_lb, np.inf,
+            coef=-1, veh=np.concatenate(lower['veh']))
+
+    # Site capacity (with battery) and number of fast chargers per period
+    row_of_tp = np.full(T, -1)
+    row_of_tp[tp] = np.arange(n_bat)
+    add_block(
+        'capacity',
+        np.concatenate([row_of_tp[t_av], np.arange(n_bat)]),
+        np.concatenate([out_col[t_av, v_av], bat_col]), 1,
+        np.full(n_bat, -np.inf), arrays['capacity'][tp] * gv.TIME_FRACT)
+    add_block(
+        'fast', row_of_tp[t_av], ch_col[t_av, v_av], 1,
+        np.full(n_bat, -np.inf), gv.NUM_FAST_CH)
+
+    # Site battery
+    add_block('battery_sum', np.zeros(n_bat, dtype=int), bat_col, 1,
+              [0], 100)
+    add_block(
+        'battery_link',
+        np.concatenate([row_of_tp[t_av], np.arange(n_bat)]),
+        np.concatenate([out_col[t_av, v_av], bat_col]), -1,
+        np.full(n_bat, -np.inf), 0)
+
+    A = sp.csr_matrix(
+        (np.concatenate(vals),
+         (np.concatenate(r_idx), np.concatenate(c_idx))),
+        shape=(n_rows, n_var))
+    cols = {
+        'output': out_col,
+        'output_available': out_col[av],
+        'charger': ch_col,
+        'battery': bat_col,
+        'battery_periods': tp,
+        'soc': soc_col,
+    }
+    model = SparseModel(
+        c, A, lb, ub, integrality,
+        np.concatenate(row_lb), np.concatenate(row_ub),
+        np.concatenate(rel_coef), np.concatenate(rel_vehicle), cols, rows)
+    model.soc_form = soc_form
+    model.vehicles = np.asarray(arrays['vehicles'])
+    return model
+
+
+def set_rel_charge(model, rel_charge):
+    """Patches the SOC dependent row bounds
+
+    Args:
+        model (SparseModel): model to update
+        rel_charge (array): initial charge relative to full per vehicle
+    """
+    model.rel_charge = np.asarray(rel_charge, dtype=float)
+    shift = model.rel_coef * model.rel_charge[model.rel_vehicle]
+    model.row_lb = model.base_lb + shift
+    model.row_ub = model.base_ub + shift
+
+
+@tm.timed('link')
+def link_days(models):
+    """Joins consecutive daily models into one, linked by their SOC
+
+    Each day starts from the previous day's final SOC variable instead
+    of a fixed initial SOC, and only the last day has to end full. The
+    daily blocks are stacked as they are, in order, so a day's block can
+    be built once and reused by every window it's part of.
+
+    Args:
+        models (list): SparseModel of each day from build_day_model,
+            in the 'state' SOC form and with the same vehicles
+
+    Returns:
+        SparseModel: model of the days, set_rel_charge sets the SOC at
+            the start of the first day. days holds the daily models and
+            cols['offset'] the first column of each (see split_days)
+    """
+    if any(m.soc_form != 'state' for m in models):
+        raise ValueError('Days can only be linked in the state SOC form')
+    start = time.perf_counter()
+    col_off = np.cumsum([0] + [m.num_variables() for m in models])
+    row_off = np.cumsum([0] + [m.num_constraints() for m in models])
+    base_lb = [m.base_lb.copy() for m in models]
+    base_ub = [m.base_ub.copy() for m in models]
+    rel_coef = [m.rel_coef.copy() for m in models]
+    link_rows, link_cols = [], []
+    for k, m in enumerate(models):
+        if k > 0:
+            prev_soc = models[k - 1].cols['soc'][-1]
+            if not np.array_equal(models[k - 1].vehicles, m.vehicles):
+                raise ValueError('Linked days must have the same vehicles,'
+                                 ' in the same order')
+            # First SOC balance rows: soc[0] - eff * output[0] - soc of
+            # the previous day's last period = use[0]
+            first = m.rows['balance'].start + np.arange(len(prev_soc))
+            link_rows.append(row_off[k] + first)
+            link_cols.append(col_off[k - 1] + prev_soc)
+            rel_coef[k][first] = 0
+        if k < len(models) - 1:
+            base_lb[k][m.rows['final']] = -np.inf
+            base_ub[k][m.rows['final']] = np.inf
+    A = sp.block_diag([m.A for m in models], format='coo')
+    if link_rows:
+        link_rows = np.concatenate(link_rows)
+        A = sp.coo_matrix(
+            (np.concatenate([A.data, -np.ones(len(link_rows))]),
+             (np.concatenate([A.row, link_rows]),
+              np.concatenate([A.col, np.concatenate(link_cols)]))),
+            shape=A.shape)
+    model = SparseModel(
+        np.concatenate([m.c for m in models]), A.tocsr(),
+        np.concatenate([m.lb for m in models]),
+        np.concatenate([m.ub for m in models]),
+        np.concatenate([m.integrality for m in models]),
+        np.concatenate(base_lb), np.concatenate(base_ub),
+        np.concatenate(rel_coef),
+        np.concatenate([m.rel_vehicle for m in models]),
+        {'offset': col_off}, {'offset': row_off})
+    model.soc_form = 'state'
+    model.vehicles = models[0].vehicles
+    model.days = models
+    model.build_time = time.perf_counter() - start
+    return model
+
+
+def split_days(model):
+    """Copies the status and solution of linked days to each day
+
+    Args:
+        model (SparseModel): solved model from link_days
+    """
+    for m, off in zip(model.days, model.cols['offset']):
+        m.status = model.status
+        m.x = None if model.x is None else model.x[
+            off:off + m.num_variables()]
+
+
+def set_level(model, level, next_req, battery_cap):
+    """Switches a Main model to a fallback level in place
+
+    Tonext (as charge_tonextday) rewards every kWh delivered (price
+    - 100) and only asks for enough charge for the next day's journeys.
+    Breach (as charge_tonextday_breach) also adds a binary per period
+    that doubles the site capacity at a cost of 1000. The matrix is only
+    extended, so the previous levels' rows and columns are kept.
+
+    Args:
+        model (SparseModel): model built by build_day_model
+        level (str): 'Tonext' or 'Breach'
+        next_req (array): battery requirements for next day per vehicle
+        battery_cap (array): battery capacity of each vehicle
+    """
+    need = np.asarray(battery_cap, dtype=float) + np.asarray(
+        next_req, dtype=float)
+    if level == 'Breach':
+        need -= 0.00001
+    final = model.rows['final']
+    if model.level == 'Main':
+        model.c[model.cols['output_available']] -= 100
+        model.c[model.cols['battery']] = 0
+        model.main_final_lb = model.base_lb[final].copy()
+    # End of day SOC >= -(capacity + next requirements), instead of 0
+    model.base_lb[final] = model.main_final_lb - need
+    model.base_ub[final] = np.inf
+    if level == 'Breach' and model.level != 'Breach':
+        cap_rows = model.rows['capacity']
+        n_new = cap_rows.stop - cap_rows.start
+        breach_col = len(model.c) + np.arange(n_new)
+        extra = sp.csr_matrix(
+            (-model.base_ub[cap_rows],
+             (np.arange(cap_rows.start, cap_rows.stop), np.arange(n_new))),
+            shape=(model.A.shape[0], n_new))
+        model.A = sp.hstack([model.A, extra], format='csr')
+        model.c = np.concatenate([model.c, np.full(n_new, 1000.)])
+        model.lb = np.concatenate([model.lb, np.zeros(n_new)])
+        model.ub = np.concatenate([model.ub, np.ones(n_new)])
+        model.integrality = np.concatenate(
+            [model.integrality, np.ones(n_new)])
+        model.cols['breach'] = breach_col
+    model.level = level
+    set_rel_charge(model, model.rel_charge)
+
+
+@tm.timed('solve')
+def solve_model(model, warm_start=False):
+    """Solves the model with the run's backend (HiGHS by default)
+
+    Time limit, gap and threads are the solvers.py settings of the run.
+
+    Args:
+        model (SparseModel): model to solve
+        warm_start (bool): start from the last solution of the model,
+            if it has one (columns added since start at 0)
+
+    Returns:
+        int: PuLP status code, also stored in model.status
+    """
+    x0 = None
+    if warm_start and model.x is not None:
+        x0 = np.zeros(len(model.c))
+        x0[:len(model.x)] = model.x
+    start = time.perf_counter()
+    res = slv.solve_arrays(
+        model.c, model.A, model.lb, model.ub, model.row_lb, model.row_ub,
+        model.integrality, x0=x0)
+    model.solve_time += time.perf_counter() - start
+    if res.solver_time is None or model.solver_time is None:
+        model.solver_time = None
+    else:
+        model.solver_time += res.solver_time
+    model.solve_path = res.solve_path
+    model.status = res.status
+    model.x = res.x
+    model.objective = res.objective
+    model.gap = res.gap
+    model.bound = res.bound
+    model.nodes = res.nodes
+    return model.status
+
+
+def model_outputs(model, arrays, output_col, ch_col):
+    """Converts a solved model to the optimiser output frames
+
+    Args:
+        model (SparseModel): solved model
+        arrays (dict): output of day_arrays
+        output_col (str): name of output column
+        ch_col (str): name of charger type column
+
+    Returns:
+        DataFrame: outputs and charger type per period / vehicle
+        DataFrame: site battery outputs per period
+    """
+    cols = model.cols
+    if model.status == 1:
+        x = model.x
+        outputs = x[cols['output']]
+        chargers = x[cols['charger']]
+        battery = x[cols['battery']]
+    else:
+        outputs = np.zeros(arrays['shape'])
+        chargers = np.zeros(arrays['shape'])
+        battery = np.zeros(len(cols['battery']))
+    index = pd.MultiIndex.from_product(
+        [arrays['from'], arrays['vehicles']], names=['from', 'Vehicle_ID'])
+    df = pd.DataFrame({
+        output_col: outputs.ravel(),
+        ch_col: chargers.ravel()}, index=index)
+    dfb = pd.DataFrame({
+        'from': arrays['from'][cols['battery_periods']],
+        'Battery_ID': np.arange(len(battery)),
+        output_col: battery})
+    return df, dfb
@@ -10,6 +10,7 @@ import datetime as dt
 import glob
 import pickle
 import global_variables as gv
+import timings as tm
 import random
 import time
 import math
@@ -94,6 +95,7 @@ def prep_data_JLP(path):
     return journeys
 
 
+@tm.timed('prep_data_mixed')
 def prep_data_mixed(path, vs, ch, dates, vNum):
     """Preprocess journey data from JLP stores with a mixed fleet
 
@@ -142,18 +144,17 @@ def prep_data_mixed(path, vs, ch, dates, vNum):
     vJourneys.loc[
         (vJourneys['Route_Cost'] == 0)
         & (vJourneys['EqMileage'] <= gv.VSPEC[vs[0]]['R']), 'Van'] = vs[0]
-    for date in dates:
-        dayJ = vJourneys.loc[date]
-        move = max(len(dayJ[dayJ['Van'] == vs[0]]) - vNum[0], 0)
-        newLarge = dayJ[dayJ['Van'] == vs[0]].sort_values(
-            by='EqMileage', ascending=False).index[:move]
-        vJourneys.loc[(date, newLarge), 'Van'] = vs[-1]
-        dayJ = vJourneys.loc[date]
-        slowidx = dayJ[dayJ['Van'] == vs[0]].index
-        fastidx = dayJ[dayJ['Van'] == vs[-1]].index
-        vJourneys.loc[(date, slowidx), 'NewVehicleID'] = range(1, len(slowidx)+1)
-        vJourneys.loc[(date, fastidx), 'NewVehicleID'] = range(
-            vNum[0]+1, vNum[0]+len(fastidx)+1)
+    # Each day, only the vNum[0] small vans with the lowest mileage stay
+    small = vJourneys['Van'] == vs[0]
+    rank = vJourneys['EqMileage'].where(small).groupby(level=0).rank(
+        ascending=False, method='first')
+    move = small.groupby(level=0).transform('sum') - vNum[0]
+    vJourneys.loc[rank <= move, 'Van'] = vs[-1]
+    # Small vans are numbered from 1, large ones from vNum[0] + 1
+    vJourneys['NewVehicleID'] = (
+        vJourneys.groupby([vJourneys.index.get_level_values(0),
+                           'Van']).cumcount() + 1
+        + np.where(vJourneys['Van'] == vs[-1], vNum[0], 0)).astype(float)
     journeys = journeys.merge(vJourneys[['Van', 'NewVehicleID']],
                               left_on=['Start_Date_of_Route', 'Vehicle_ID'],
                               right_index=True)
@@ -163,9 +164,10 @@ def prep_data_mixed(path, vs, ch, dates, vNum):
     journeys.sort_values(by=['date', 'Route_ID'], inplace=True)
     journeys.reset_index(inplace=True)
     journeys.set_index(['date', 'Route_ID'], inplace=True)
+    consumption = {v: gv.VSPEC[v]['D'] for v in vs}
     journeys['Energy_Required'] = (
         journeys['Planned_total_Mileage']
-        * journeys['Van'].map(gv.VSPEC).apply(pd.Series)['D']
+        * journeys['Van'].map(consumption)
         + journeys['Route_Time'] * gv.REF_CONS)
     journeys.drop(columns=['NewVehicleID', 'Req_Energy'], inplace=True)
     dictV = {i: vs[0] for i in range(1, vNum[0]+1)}
@@ -176,37 +178,32 @@ def prep_data_mixed(path, vs, ch, dates, vNum):
 def get_prev_arrival(journeys):
     """Get column for previous arrival time / next departure for each van
 
+    Journeys are sorted by van (in order of first appearance) and start
+    time, and the times are shifted within each van.
+
     Args:
         journeys (DataFrame): table of all journeys per vehicle
 
     Returns:
         DataFrame: same table as input with aditional information
     """
-    vans = journeys['Vehicle_ID'].unique()
-    print(vans)
-    van_journeys_list = []
-    for van in vans:
-        van_journeys = journeys[journeys['Vehicle_ID'] == van].copy()
-        van_journeys.sort_values(
-            by=['Start_Time_of_Route'],
-            inplace=True,
-            ascending=False)
-        next_departure = dt.datetime.combine(
-            max(journeys['date']),
-            dt.datetime.min.time()
-        ) + dt.timedelta(days=1, hours=6)
-        for idx in van_journeys.index:
-            van_journeys.loc[idx, 'Next_Departure'] = next_departure
-            next_departure = van_journeys.loc[idx, 'Start_Time_of_Route']
-        van_journeys.sort_values(by=['Start_Time_of_Route'], inplace=True)
-        # previous_arrival = dt.datetime.combine(
-        #     min(journeys['date']),
-        #     dt.datetime.min.time())
-        # for idx in van_journeys.index:
-        #     van_journeys.loc[idx, 'Previous_Arrival'] = previous_arrival
-        #     previous_arrival = van_journeys.loc[idx, 'End_Time_of_Route']
-        van_journeys_list.append(van_journeys)
-    return pd.concat(van_journeys_list)
+    van_order = pd.factorize(journeys['Vehicle_ID'])[0]
+    order = np.lexsort(
+        (journeys['Start_Time_of_Route'].values, van_order))
+    journeys = journeys.iloc[order].copy()
+    vans = journeys.groupby('Vehicle_ID', sort=False)
+    last_departure = dt.datetime.combine(
+        max(journeys['date']),
+        dt.datetime.min.time()
+    ) + dt.timedelta(days=1, hours=6)
+    first_arrival = dt.datetime.combine(
+        min(journeys['date']),
+        dt.datetime.min.time())
+    journeys['Next_Departure'] = vans['Start_Time_of_Route'].shift(
+        -1).fillna(last_departure)
+    journeys['Previous_Arrival'] = vans['End_Time_of_Route'].shift(
+        1).fillna(first_arrival)
+    return journeys
 
 
 def remove_busy_routes(journeys):
@@ -304,6 +301,7 @@ def BAU_pricing(jour):
     return df
 
 
+@tm.timed('pricing')
 def clean_JLpricing(path, dates):
     """Creates df with electricity and time price based on JL tariff
 
@@ -350,11 +348,14 @@ def create_range_times(time_range, eprice):
     return timeline
 
 
+@tm.timed('create_empty_schedule')
 def create_empty_schedule(journeys, eprice):
     """Creates a empty schedule for each vehicle in a range
 
     Includes journey information as availability, energy consumption
-    and electricity price.
+    and electricity price. All route start/end times are mapped to
+    time periods in one go (np.searchsorted over the price timeline)
+    and availability is filled with a cumulative difference per vehicle.
 
     Args:
         journeys (DataFrame): Contains Start/End time of each route.
@@ -372,41 +373,59 @@ def create_empty_schedule(journeys, eprice):
     end_range = (dt.datetime.combine(end_date.date(), gv.CHAR_ST)
                  + dt.timedelta(days=1))
     time_range = [start_range, end_range]
-    num_days = (end_date.date() - start_date.date()).days
-    # days_profile = {}
+    timeline = create_range_times(time_range, eprice).sort_values('from')
     vehicles = journeys['Vehicle_ID'].unique()
-    veh_profiles_list = []
-    for vehicle in vehicles:
-        veh_profile = create_range_times(time_range, eprice)
-        veh_profile['Vehicle_ID'] = vehicle
-        veh_profile['Available'] = 1
-        veh_profile['Battery_Use'] = 0
-        # Get journeys for that vehicle
-        veh_journeys = journeys[journeys['Vehicle_ID'] == vehicle].droplevel(
-            'date')
-        veh_journeys = veh_journeys.sort_values(by='Start_Time_of_Route')
+    frm = timeline['from'].values
+    num_tp = len(frm)
+    num_v = len(vehicles)
+
+    # Time period indices of each route (same rules as tp_journeys)
+    veh = pd.Index(vehicles).get_indexer(journeys['Vehicle_ID'])
+    start = journeys['Start_Time_of_Route'].values
+    end = journeys['End_Time_of_Route'].values
+    first_out = np.searchsorted(frm, start - np.timedelta64(gv.TIME_INT),
+                                side='right')
+    first_back = np.searchsorted(frm, end + np.timedelta64(gv.IS_LEEWAY),
+                                 side='left')
+    ret = np.searchsorted(frm, end, side='left') - 1
+
+    # Assign 0 to availability when vehicle is out
+    away = np.zeros((num_v, num_tp + 1), dtype=int)
+    trip = first_out < first_back
+    np.add.at(away, (veh[trip], first_out[trip]), 1)
+    np.add.at(away, (veh[trip], first_back[trip]), -1)
+    available = (away.cumsum(axis=1)[:, :num_tp] == 0).astype(int)
+
+    # Assign energy used when vehicle returns. If two routes return in
+    # the same period, the one that started last is kept
+    returns = pd.DataFrame({
+        'veh': veh, 'tp': ret, 'start': start,
+        'use': -journeys['Energy_Required'].values})
+    returns = returns[returns['tp'] >= 0].sort_values(
+        ['veh', 'start'], kind='mergesort').drop_duplicates(
+            ['veh', 'tp'], keep='last')
+    battery_use = np.zeros((num_v, num_tp))
+    battery_use[returns['veh'].values, returns['tp'].values] = (
+        returns['use'].values)
 
-        for route in veh_journeys.index:
-            # Assign 0 to availability when vehicle is out
-            idx_unav, idx_return = tp_journeys(veh_profile, veh_journeys, route)
-            veh_profile.loc[idx_unav, 'Available'] = 0
-            # Assign energy used when vehicle returns
-            veh_profile.loc[idx_return, 'Battery_Use'] = -veh_journeys.loc[
-                        route, 'Energy_Required']
-        veh_profiles_list.append(veh_profile)
-    #print(veh_profiles_list)
-    profiles = pd.concat(veh_profiles_list)
-    profiles.sort_values(by=['from', 'Vehicle_ID'], inplace=True)
-    profiles.set_index(['from', 'Vehicle_ID'], inplace=True)
     # Creates a column to identify a charging session for each vehicle
-    profiles['Session'] = 0
-    profiles['Return'] = (profiles['Battery_Use'] != 0).astype(int)
-    session_num = 0
-    for v in vehicles:
-        profiles.loc[(slice(None), v), 'Session'] = (
-            session_num + profiles.loc[(slice(None), v), 'Return'].cumsum())
-        session_num = profiles['Session'].max()
-    profiles['Session'] = profiles['Session'] * profiles['Available']
+    is_return = (battery_use != 0).astype(int)
+    offset = np.concatenate([[0], is_return.sum(axis=1).cumsum()[:-1]])
+    session = (offset[:, None] + is_return.cumsum(axis=1)) * available
+
+    # Long format, sorted by time period then Vehicle_ID
+    order = np.argsort(vehicles, kind='stable')
+    profiles = pd.DataFrame({
+        'from': np.repeat(frm, num_v),
+        'Vehicle_ID': np.tile(vehicles[order], num_tp),
+    })
+    for col in ['Electricity_Price', 'Time_Price', 'date']:
+        profiles[col] = np.repeat(timeline[col].values, num_v)
+    profiles['Available'] = available[order].T.ravel()
+    profiles['Battery_Use'] = battery_use[order].T.ravel()
+    profiles['Session'] = session[order].T.ravel()
+    profiles['Return'] = is_return[order].T.ravel()
+    profiles.set_index(['from', 'Vehicle_ID'], inplace=True)
     return profiles
 
 def setup_inputs(journeys, eprice):
@@ -529,6 +548,7 @@ def create_daily(profile, day):
     return day_profile
 
 
+@tm.timed('capacity')
 def clean_site_capacityJLP(br, year, path):
     """Creates a df of available capacity for each time period
 
@@ -0,0 +1,127 @@
+# Wall time, CPU time and call counts of each stage of a run
+# Stages add up per process while a run goes, and are saved as JSON/CSV
+# next to the grid file to see where a slow run spent its time.
+
+import contextlib
+import functools
+import json
+import threading
+import time
+import pandas as pd
+
+STAGES = {}  # name: {'calls', 'wall', 'cpu'}
+_lock = threading.Lock()
+
+
+def start():
+    """Starting clock of a stage timed with stop()"""
+    return time.perf_counter(), time.process_time()
+
+
+def stop(name, started):
+    """Adds the time since start() to a stage
+
+    CPU time is for the whole process, so it includes the pipeline's
+    worker thread when it's running at the same time.
+
+    Args:
+        name (str): stage name
+        started (tuple): output of start()
+
+    Returns:
+        float: wall time of this call (s)
+    """
+    wall = time.perf_counter() - started[0]
+    cpu = time.process_time() - started[1]
+    with _lock:
+        rec = STAGES.setdefault(name, {'calls': 0, 'wall': 0., 'cpu': 0.})
+        rec['calls'] += 1
+        rec['wall'] += wall
+        rec['cpu'] += cpu
+    return wall
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times a with block as a stage
+
+    Stages can be nested, the inner time is counted in both.
+    """
+    started = start()
+    try:
+        yield
+    finally:
+        stop(name, started)
+
+
+def timed(name):
+    """Decorator timing every call of a function as a stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    """Clears the stages of this process (at the start of a run)"""
+    with _lock:
+        STAGES.clear()
+
+
+def snapshot():
+    """Copy of the stages so far, to send from a pool process"""
+    with _lock:
+        return {k: dict(v) for k, v in STAGES.items()}
+
+
+def merge(*stages):
+    """Adds up stage records from several processes
+
+    Args:
+        stages (dict): outputs of snapshot()
+
+    Returns:
+        dict: name: summed record
+    """
+    total = {}
+    for st in stages:
+        for name, rec in st.items():
+            out = total.setdefault(name, {'calls': 0, 'wall': 0., 'cpu': 0.})
+            for k in out:
+                out[k] += rec[k]
+    return total
+
+
+def table(stages):
+    """Stage records as a DataFrame, slowest first
+
+    Args:
+        stages (dict): output of snapshot() or merge()
+
+    Returns:
+        DataFrame: calls, wall and cpu (s) per stage
+    """
+    df = pd.DataFrame.from_dict(stages, orient='index',
+                                columns=['calls', 'wall', 'cpu'])
+    df.index.name = 'stage'
+    return df.sort_values('wall', ascending=False)
+
+
+def timings_path(grid_file_path, run):
+    """Path (without extension) of a run's timings, beside the grid file"""
+    return '{}_timings_{}'.format(grid_file_path.rsplit('.', 1)[0], run)
+
+
+def save(stages, path):
+    """Writes stage records to path.json and path.csv
+
+    Args:
+        stages (dict): output of snapshot() or merge()
+        path (str): file path without extension
+    """
+    with open(path + '.json', 'w') as f:
+        json.dump(stages, f, indent=1)
+    table(stages).to_csv(path + '.csv')